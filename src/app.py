@@ -2,12 +2,20 @@ import streamlit as st
 import os
 from PIL import Image
 import google.generativeai as genai
-from utils import apply_distortions, get_gemini_response
+from utils import get_gemini_response, get_warp_cache_stats, set_warp_cache_limit, ResponseCache, CircuitBreaker, run_bulk_analysis, ResultWriter, RunManifest, run_config_hash, read_results, ThumbnailIndex, discover_images, cached_distortions, preview_distortions, proxy_image, image_identity, assign_rain_variants, timed_stage, stage_percentiles, STAGE_COLUMNS, EXPECTED_JSON_FIELDS, DEFAULT_SYSTEM_INSTRUCTIONS
 import traceback
-import pandas as pd
 from io import StringIO
 import io
-import json
+import time
+
+# Location of the on-disk cache of model responses
+RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "road_safety_platform", "responses.sqlite")
+
+# Bulk runs stream their results into files here
+RESULTS_DIR = os.path.join(os.path.expanduser("~"), ".cache", "road_safety_platform", "results")
+
+# Thumbnails of images found in folder mode
+THUMBNAIL_DIR = os.path.join(os.path.expanduser("~"), ".cache", "road_safety_platform", "thumbnails")
 
 # Set page configuration
 st.set_page_config(page_title="Multimodal LLM Road Safety Platform", layout="wide")
@@ -34,17 +42,7 @@ if 'use_system_instructions' not in st.session_state:
     st.session_state.use_system_instructions = True
 
 if 'system_instructions' not in st.session_state:
-    st.session_state.system_instructions = """
-    You are an AI assistant specialized in analyzing road safety images. Your task is to:
-    1. Describe the scene(s) objectively, noting visible road features, signage, and potential hazards.
-    2. Identify potential safety issues or concerns based on what you can see in the image(s).
-    3. Suggest improvements or preventive measures for any identified issues.
-    4. Comment on the overall safety of the scene(s) depicted.
-    5. If multiple images are provided, note any significant differences or patterns, but do not assume they are necessarily sequential or related unless explicitly stated.
-    6. Analyze each image individually, whether it's a single frame or part of a set.
-    7. If any distortions or unusual visual effects are present, mention them only if they are clearly visible and relevant to safety analysis.
-    Please provide your analysis in a clear, concise manner, focusing on road safety aspects. Adapt your response to the number and nature of the images provided.
-    """
+    st.session_state.system_instructions = DEFAULT_SYSTEM_INSTRUCTIONS
 
 if 'api_key' not in st.session_state:
     st.session_state.api_key = ""
@@ -52,6 +50,49 @@ if 'api_key' not in st.session_state:
 if 'model_choice' not in st.session_state:
     st.session_state.model_choice = "gemini-1.5-flash-latest"
 
+if 'compiled_pipeline' not in st.session_state:
+    st.session_state.compiled_pipeline = False
+
+if 'warp_cache_mb' not in st.session_state:
+    st.session_state.warp_cache_mb = 512
+
+if 'low_memory_warp' not in st.session_state:
+    st.session_state.low_memory_warp = False
+
+if 'use_response_cache' not in st.session_state:
+    st.session_state.use_response_cache = True
+
+if 'refresh_response_cache' not in st.session_state:
+    st.session_state.refresh_response_cache = False
+
+if 'response_cache_ttl_hours' not in st.session_state:
+    st.session_state.response_cache_ttl_hours = 0
+
+if 'response_cache_mb' not in st.session_state:
+    st.session_state.response_cache_mb = 100
+
+if 'payload_max_long_edge' not in st.session_state:
+    st.session_state.payload_max_long_edge = 0
+
+if 'payload_format' not in st.session_state:
+    st.session_state.payload_format = "PNG"
+
+if 'payload_quality' not in st.session_state:
+    st.session_state.payload_quality = 85
+
+# Stage timings of recent analyses, for the performance panel
+if 'stage_timings' not in st.session_state:
+    st.session_state.stage_timings = []
+
+if 'images_per_minute' not in st.session_state:
+    st.session_state.images_per_minute = None
+
+if 'structured_output' not in st.session_state:
+    st.session_state.structured_output = False
+
+if 'proxy_previews' not in st.session_state:
+    st.session_state.proxy_previews = True
+
 # Predefined Prompts
 PREDEFINED_PROMPTS = [
     "Analyze the road safety features visible in this image.",
@@ -66,26 +107,34 @@ PREDEFINED_PROMPTS = [
     "Identify any potential blind spots or visual obstructions for drivers.",
 ]
 
+# Number of recent analyses the performance panel summarises
+STAGE_TIMING_HISTORY = 1000
+
+def record_stage_timings(row):
+    # row holds the STAGE_COLUMNS of a result row
+    st.session_state.stage_timings.append({column: row.get(column, 0.0) for column in STAGE_COLUMNS.values()})
+    del st.session_state.stage_timings[:-STAGE_TIMING_HISTORY]
+
+def show_performance(panel):
+    # p50/p95 of each stage over recent analyses, and the throughput of the current or last bulk run
+    with panel.container():
+        st.subheader("Performance")
+        if not st.session_state.stage_timings:
+            st.caption("Stage timings appear here after an analysis.")
+            return
+        percentiles = stage_percentiles(st.session_state.stage_timings)
+        st.dataframe(percentiles.map(lambda seconds: f"{seconds * 1000:.0f} ms"), use_container_width=True)
+        if st.session_state.images_per_minute is not None:
+            st.metric("Bulk throughput", f"{st.session_state.images_per_minute:.1f} images/min")
+        st.caption(f"Over the last {len(st.session_state.stage_timings)} analyses")
+
+def default_image_settings():
+    # Settings of an image whose widgets have not been shown yet, matching the widget defaults
+    return {"distortions": [], "input_text": PREDEFINED_PROMPTS[0]}
+
 # Distortion Types
 DISTORTION_TYPES = ["None", "Blur", "Brightness", "Contrast", "Sharpness", "Color", "Rain", "Overlay", "Warp"]
 
-# Expected JSON Fields
-EXPECTED_JSON_FIELDS = [
-    "scene_description",
-    "safety_features",
-    "potential_hazards",
-    "traffic_signs_effectiveness",
-    "road_conditions",
-    "suggested_improvements",
-    "intersection_design",
-    "road_markings_issues",
-    "cyclist_safety",
-    "lighting_conditions",
-    "traffic_lights_visibility",
-    "blind_spots",
-    "overall_safety"
-]
-
 # Title
 st.title("Multimodal LLM Road Safety Platform")
 
@@ -98,6 +147,107 @@ st.session_state.model_choice = st.sidebar.selectbox(
     index=["gemini-1.5-flash-latest", "gemini-1.5-pro"].index(st.session_state.model_choice)
 )
 
+st.session_state.compiled_pipeline = st.sidebar.checkbox(
+    "Fast distortion pipeline",
+    value=st.session_state.compiled_pipeline,
+    help="Run distortion chains on a single reused working buffer (output is always RGB)."
+)
+
+st.session_state.proxy_previews = st.sidebar.checkbox(
+    "Fast previews",
+    value=st.session_state.proxy_previews,
+    help="Preview distortions on a 640 px copy with sizes scaled to match; full-resolution images are only processed for analysis."
+)
+
+st.session_state.warp_cache_mb = st.sidebar.number_input(
+    "Warp map cache (MB)",
+    min_value=0,
+    value=st.session_state.warp_cache_mb,
+    step=64,
+    help="Memory for reusing Warp coordinate maps across images of the same size and settings."
+)
+set_warp_cache_limit(st.session_state.warp_cache_mb * 1024 * 1024)
+
+st.session_state.low_memory_warp = st.sidebar.checkbox(
+    "Low-memory warp",
+    value=st.session_state.low_memory_warp,
+    help="Warp large images strip by strip instead of through a full-frame coordinate map (and skip the map cache). Use it when bulk runs on very large images run out of memory."
+)
+
+@st.cache_resource
+def get_response_cache(path):
+    return ResponseCache(path)
+
+@st.cache_resource
+def get_thumbnail_index(path):
+    return ThumbnailIndex(path)
+
+thumbnail_index = get_thumbnail_index(THUMBNAIL_DIR)
+
+@st.cache_data(show_spinner="Scanning folder...", ttl=600)
+def discover_folder(folder, recursive, include, exclude, every_nth, sample_size, limit):
+    return discover_images(folder, recursive, list(include), list(exclude), every_nth, sample_size, limit, seed=0)
+
+st.sidebar.subheader("Response Cache")
+
+st.session_state.use_response_cache = st.sidebar.checkbox(
+    "Use response cache",
+    value=st.session_state.use_response_cache,
+    help="Reuse stored answers for the same image, prompt, instructions and model instead of calling the API again."
+)
+
+if st.session_state.use_response_cache:
+    st.session_state.refresh_response_cache = st.sidebar.checkbox(
+        "Refresh cached responses",
+        value=st.session_state.refresh_response_cache,
+        help="Always call the model and overwrite the stored answers."
+    )
+    st.session_state.response_cache_ttl_hours = st.sidebar.number_input(
+        "Cache expiry (hours, 0 = never)",
+        min_value=0,
+        value=st.session_state.response_cache_ttl_hours
+    )
+    st.session_state.response_cache_mb = st.sidebar.number_input(
+        "Cache size limit (MB)",
+        min_value=1,
+        value=st.session_state.response_cache_mb
+    )
+    response_cache = get_response_cache(RESPONSE_CACHE_PATH)
+    response_cache.max_bytes = st.session_state.response_cache_mb * 1024 * 1024
+    response_cache.ttl_seconds = st.session_state.response_cache_ttl_hours * 3600 or None
+else:
+    response_cache = None
+
+st.sidebar.subheader("Response Format")
+
+st.session_state.structured_output = st.sidebar.checkbox(
+    "Structured JSON output",
+    value=st.session_state.structured_output,
+    help="Ask the model for schema-constrained JSON instead of parsing ===JSON=== markers out of free text. Falls back to free text if the structured call fails."
+)
+
+st.sidebar.subheader("Upload Optimisation")
+
+st.session_state.payload_max_long_edge = st.sidebar.number_input(
+    "Max long edge (px, 0 = original)",
+    min_value=0,
+    value=st.session_state.payload_max_long_edge,
+    step=256,
+    help="Downscale images before upload; the model resizes large images internally anyway."
+)
+st.session_state.payload_format = st.sidebar.selectbox(
+    "Upload format",
+    ["PNG", "JPEG", "WEBP"],
+    index=["PNG", "JPEG", "WEBP"].index(st.session_state.payload_format)
+)
+if st.session_state.payload_format != "PNG":
+    st.session_state.payload_quality = st.sidebar.slider(
+        "Upload quality",
+        10,
+        100,
+        st.session_state.payload_quality
+    )
+
 st.sidebar.subheader("System Instructions")
 
 # Add the toggle button
@@ -113,6 +263,9 @@ if st.session_state.use_system_instructions:
 else:
     st.sidebar.info("System instructions are disabled.")
 
+performance_panel = st.sidebar.empty()
+show_performance(performance_panel)
+
 st.session_state.api_key = st.text_input("Enter your Gemini API key:", type="password", value=st.session_state.api_key)
 
 if st.session_state.api_key:
@@ -174,7 +327,8 @@ if st.session_state.api_key:
                                 'wave_amplitude': wave_amplitude,
                                 'wave_frequency': wave_frequency,
                                 'bulge_factor': bulge_factor
-                            }
+                            },
+                            'tiled': st.session_state.low_memory_warp
                         })
                     else:
                         intensity = st.slider(f"{distortion_type} Intensity", 0.0, 1.0, 0.5)
@@ -193,25 +347,31 @@ if st.session_state.api_key:
         uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
 
         image = None
-        processed_image = None
+        image_key = None
         if uploaded_file:
             try:
+                image_key = image_identity(uploaded_file)
+                # Previews are distorted on a downscaled copy; the full image is only processed on Analyse
+                if st.session_state.proxy_previews:
+                    preview, preview_scale = proxy_image(uploaded_file)
+                else:
+                    preview, preview_scale = Image.open(uploaded_file), 1.0
                 image = Image.open(uploaded_file)
 
                 if distortions:
-                    processed_image = apply_distortions(image, distortions)
-                    if processed_image is not None:
+                    # Reused across reruns until the image or the distortion settings change
+                    processed_preview = preview_distortions(preview, distortions, preview_scale, image_key, compiled=st.session_state.compiled_pipeline)
+                    if processed_preview is not None:
                         col1, col2 = st.columns(2)
                         with col1:
-                            st.image(image, caption="Original Image", use_column_width=True)
+                            st.image(preview, caption="Original Image", use_column_width=True)
                         with col2:
                             caption = f"Processed Image ({', '.join([d['type'] for d in distortions])})"
-                            st.image(processed_image, caption=caption, use_column_width=True)
+                            st.image(processed_preview, caption=caption, use_column_width=True)
                     else:
                         st.error("Failed to process the image. The distortion function returned None.")
                 else:
-                    st.image(image, caption="Original Image", use_column_width=True)
-                    processed_image = image  # If no distortions, use the original image
+                    st.image(preview, caption="Original Image", use_column_width=True)
             except Exception as e:
                 st.error(f"An error occurred while processing the image: {str(e)}")
                 st.error(traceback.format_exc())
@@ -219,15 +379,30 @@ if st.session_state.api_key:
         submit = st.button("Analyse")
 
         if submit:
-            if input_text or processed_image:
+            if input_text or image:
                 try:
+                    stats = {}
+                    processed_image = image
+                    if image is not None and distortions:
+                        with timed_stage(stats, "distort"):
+                            processed_image = cached_distortions(image, distortions, image_key, compiled=st.session_state.compiled_pipeline)
+
                     text_response, json_response = get_gemini_response(
                         input_text,
                         processed_image,
                         st.session_state.model_choice,
                         st.session_state.system_instructions if st.session_state.use_system_instructions else None,
-                        EXPECTED_JSON_FIELDS  # Add this line
+                        EXPECTED_JSON_FIELDS,  # Add this line
+                        cache=response_cache,
+                        refresh_cache=st.session_state.refresh_response_cache,
+                        max_long_edge=st.session_state.payload_max_long_edge or None,
+                        image_format=st.session_state.payload_format,
+                        quality=st.session_state.payload_quality,
+                        structured_output=st.session_state.structured_output,
+                        stats=stats
                     )
+                    record_stage_timings({column: stats.get(f"{stage.lower()}_seconds", 0.0) for stage, column in STAGE_COLUMNS.items()})
+                    show_performance(performance_panel)
 
                     st.subheader("User Input")
                     st.write(input_text if input_text else "[No text input]")
@@ -235,6 +410,11 @@ if st.session_state.api_key:
                     st.subheader("AI Response")
                     st.write(text_response)
 
+                    timings = [f"{stage} {stats[f'{stage.lower()}_seconds']:.2f}s" for stage in STAGE_COLUMNS if f"{stage.lower()}_seconds" in stats]
+                    if "prompt_tokens" in stats:
+                        timings.append(f"{stats['prompt_tokens']} prompt / {stats.get('response_tokens', 0)} response tokens")
+                    st.caption(" · ".join(timings))
+
                     # Remove the JSON Response display here
 
                 except Exception as e:
@@ -348,6 +528,27 @@ if st.session_state.api_key:
                                 'bulge_factor': bulge_factor
                             }
                         }
+                    elif distortion_type == "Rain":
+                        previous = centralized_distortion_settings.get(distortion_type, {})
+                        intensity = st.slider(f"{distortion_type} Intensity", 0.0, 1.0, previous.get('intensity', 0.5))
+                        seed = st.number_input(
+                            "Rain seed",
+                            min_value=0,
+                            value=previous.get('seed', 0),
+                            help="The same seed gives the same rain on every run."
+                        )
+                        variants = st.slider(
+                            "Rain variations",
+                            1,
+                            8,
+                            previous.get('variants', 1),
+                            help="Number of different rain layers the images take turns using. Each layer is generated once per image size."
+                        )
+                        centralized_distortion_settings[distortion_type] = {
+                            'intensity': intensity,
+                            'seed': seed,
+                            'variants': variants
+                        }
                     else:
                         intensity = st.slider(
                             f"{distortion_type} Intensity",
@@ -362,6 +563,7 @@ if st.session_state.api_key:
         st.subheader("Bulk Analysis")
 
         analysis_source = st.radio("Choose analysis source:", ["Upload Files", "Specify Folder Path"])
+        thumbnail_entries = {}
 
         if analysis_source == "Upload Files":
             # File uploader for multiple images
@@ -376,21 +578,42 @@ if st.session_state.api_key:
 
             folder_path = st.text_input("Enter folder path containing images:")
 
+            with st.expander("Discovery options"):
+                recursive = st.checkbox("Include subfolders", value=False)
+                include_patterns = st.text_input("Include patterns", help="Comma-separated globs, e.g. *.jpg, cam1/* (patterns with a / match the path inside the folder)")
+                exclude_patterns = st.text_input("Exclude patterns", help="Comma-separated globs, e.g. *_mask.png, */calibration/*")
+                sampling = st.radio("Sampling", ["All images", "Every Nth image", "Random sample"], horizontal=True)
+                every_nth = st.number_input("N", min_value=1, value=10) if sampling == "Every Nth image" else 1
+                sample_size = st.number_input("Sample size", min_value=1, value=100) if sampling == "Random sample" else None
+                image_limit = st.number_input("Maximum number of images (0 = no limit)", min_value=0, value=0)
+                if st.button("Rescan folder"):
+                    discover_folder.clear()
+
             if folder_path:
                 if os.path.isdir(folder_path):
-                    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-                    uploaded_files = [os.path.join(folder_path, f) for f in image_files]
+                    uploaded_files = discover_folder(
+                        folder_path,
+                        recursive,
+                        tuple(p.strip() for p in include_patterns.split(",")),
+                        tuple(p.strip() for p in exclude_patterns.split(",")),
+                        every_nth,
+                        sample_size,
+                        image_limit or None
+                    )
                     st.success(f"Found {len(uploaded_files)} images in the specified folder.")
+                    if image_limit and len(uploaded_files) >= image_limit:
+                        st.warning(f"Stopped at the limit of {image_limit} images; the folder may hold more. Raise the maximum in the discovery options to include them.")
 
                     # Display a sample of found images
                     if uploaded_files:
                         st.write("Sample of found images:")
-                        sample_size = min(5, len(uploaded_files))
-                        sample_images = uploaded_files[:sample_size]
-                        cols = st.columns(sample_size)
+                        sample_images = uploaded_files[:5]
+                        # Thumbnails are generated once per image; later reruns only read the small copies
+                        thumbnail_entries = thumbnail_index.build(sample_images)
+                        cols = st.columns(len(sample_images))
                         for i, img_path in enumerate(sample_images):
                             with cols[i]:
-                                st.image(Image.open(img_path), caption=os.path.basename(img_path), use_column_width=True)
+                                st.image(thumbnail_index.thumbnail(img_path), caption=os.path.basename(img_path), use_column_width=True)
                 else:
                     st.error("Invalid folder path. Please check and try again.")
                     uploaded_files = []
@@ -402,43 +625,43 @@ if st.session_state.api_key:
             st.session_state.previous_file_count = 0
 
         if len(uploaded_files) != st.session_state.previous_file_count:
-            st.session_state.image_settings = []
+            st.session_state.image_settings = {}
             st.session_state.previous_file_count = len(uploaded_files)
 
-        # Create or update image settings
+        # Per-image settings, created when an image is first shown; images that were never
+        # shown use the same defaults as the widgets below
         if 'image_settings' not in st.session_state:
-            st.session_state.image_settings = []
+            st.session_state.image_settings = {}
 
         if uploaded_files:
-            # Ensure image_settings has the same length as uploaded_files
-            while len(st.session_state.image_settings) < len(uploaded_files):
-                st.session_state.image_settings.append({
-                    "distortion": "None",
-                    "intensity": 0.5,
-                    "input_text": "",
-                    "overlay_image": None,
-                    "warp_params": {
-                        "wave_amplitude": 20.0,
-                        "wave_frequency": 0.04,
-                        "bulge_factor": 30.0
-                    },
-                    "saturation": 1.0,
-                    "hue_shift": 0.0
-                })
-
-            # Remove extra settings if files were removed
-            st.session_state.image_settings = st.session_state.image_settings[:len(uploaded_files)]
-
-            for i, (file, settings) in enumerate(zip(uploaded_files, st.session_state.image_settings)):
-                file_name = file.name if hasattr(file, 'name') else os.path.basename(file)
+            # Only one page of settings widgets is built per rerun
+            page_size = st.selectbox("Images per page", [10, 25, 50, 100])
+            page_count = (len(uploaded_files) + page_size - 1) // page_size
+            page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1) if page_count > 1 else 1
+            page_start = (page - 1) * page_size
+            page_files = uploaded_files[page_start:page_start + page_size]
+            if page_files and isinstance(page_files[0], str):
+                # Thumbnails for the page are made in parallel the first time it is shown
+                with st.spinner("Indexing images..."):
+                    thumbnail_entries.update(thumbnail_index.build(page_files))
+
+            for i, file in enumerate(page_files, start=page_start):
+                settings = st.session_state.image_settings.setdefault(i, default_image_settings())
+                file_name = file.name if hasattr(file, 'name') else os.path.relpath(file, folder_path)
 
                 with st.expander(f"Settings for {file_name}", expanded=True):
                     col1, col2 = st.columns(2)
 
                     with col1:
-                        # Load and display original image
-                        image = Image.open(file) if isinstance(file, str) else Image.open(file)
-                        st.image(image, caption="Original Image", use_column_width=True)
+                        # Load and display original image; folder images are previewed from their thumbnails
+                        if isinstance(file, str):
+                            image = thumbnail_index.thumbnail(file)
+                            entry = thumbnail_entries.get(file) or thumbnail_index.metadata(file)
+                            preview_scale = max(image.size) / max(entry["width"], entry["height"])
+                            st.image(image, caption=f"Original Image ({entry['width']}x{entry['height']} {entry['format']})", use_column_width=True)
+                        else:
+                            image, preview_scale = proxy_image(file) if st.session_state.proxy_previews else (Image.open(file), 1.0)
+                            st.image(image, caption="Original Image", use_column_width=True)
 
                     with col2:
                         if use_centralized_distortions:
@@ -540,6 +763,22 @@ if st.session_state.api_key:
                                             settings.get(f"{distortion_type}_intensity", 0.5),
                                             key=f"intensity_{i}_{distortion_type}"
                                         )
+                                        if distortion_type == "Rain":
+                                            settings[f"{distortion_type}_seed"] = st.number_input(
+                                                "Rain seed",
+                                                min_value=0,
+                                                value=settings.get(f"{distortion_type}_seed", 0),
+                                                help="The same seed gives the same rain on every run.",
+                                                key=f"seed_{i}_{distortion_type}"
+                                            )
+                                            settings[f"{distortion_type}_variants"] = st.slider(
+                                                "Rain variations",
+                                                1,
+                                                8,
+                                                settings.get(f"{distortion_type}_variants", 1),
+                                                help="Number of different rain layers the images take turns using. Each layer is generated once per image size.",
+                                                key=f"variants_{i}_{distortion_type}"
+                                            )
 
                         # Apply distortions and display processed image
                         distortions_list = []
@@ -550,11 +789,7 @@ if st.session_state.api_key:
                                 distortion_params["hue_shift"] = settings.get(f"{distortion_type}_hue_shift", 0.0)
                             elif distortion_type == "Overlay":
                                 distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
-                                overlay_image_bytes = settings.get(f"{distortion_type}_overlay_image")
-                                if overlay_image_bytes:
-                                    distortion_params["overlay_image"] = Image.open(io.BytesIO(overlay_image_bytes)).convert("RGBA")
-                                else:
-                                    distortion_params["overlay_image"] = None
+                                distortion_params["overlay_image"] = settings.get(f"{distortion_type}_overlay_image") or None
                             elif distortion_type == "Warp":
                                 distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
                                 distortion_params["warp_params"] = {
@@ -562,13 +797,21 @@ if st.session_state.api_key:
                                     "wave_frequency": settings.get(f"{distortion_type}_wave_frequency", 0.04),
                                     "bulge_factor": settings.get(f"{distortion_type}_bulge_factor", 30.0)
                                 }
+                                distortion_params["tiled"] = st.session_state.low_memory_warp
                             else:
                                 distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
+                                if distortion_type == "Rain":
+                                    distortion_params["seed"] = settings.get(f"{distortion_type}_seed", 0)
+                                    distortion_params["variants"] = settings.get(f"{distortion_type}_variants", 1)
                             distortions_list.append(distortion_params)
+                        # The preview shows the rain layer this image gets in the bulk run
+                        distortions_list = assign_rain_variants(distortions_list, i)
 
                         # Only apply distortions if there are valid distortions to apply
                         if any(d for d in distortions_list if d.get("overlay_image") is not None or d["type"] != "Overlay"):
-                            processed_image = apply_distortions(image, distortions_list)
+                            # Folder images are previewed from their thumbnails, so those get their own cache entries
+                            image_key = (image_identity(file), "thumbnail") if isinstance(file, str) else image_identity(file)
+                            processed_image = preview_distortions(image, distortions_list, preview_scale, image_key, compiled=st.session_state.compiled_pipeline)
                         else:
                             processed_image = image
 
@@ -592,143 +835,200 @@ if st.session_state.api_key:
 
                 st.markdown("---")  # Add a separator between images
 
-        # Button to start bulk analysis
-        if st.button("Run Bulk Analysis") and uploaded_files:
-            results = []
-            progress_bar = st.progress(0)
-
-            for i, file in enumerate(uploaded_files):
-                try:
-                    image = Image.open(file)
-                    file_name = file.name if hasattr(file, 'name') else os.path.basename(file)
-
-                    # Apply distortions
-                    distortions_list = []
-                    if use_centralized_distortions:
-                        for distortion_type in centralized_distortions:
-                            distortion_params = {"type": distortion_type}
-                            if distortion_type == "Overlay":
-                                distortion_params["intensity"] = centralized_distortion_settings[distortion_type]['intensity']
-                                # Convert bytes back to PIL Image for overlay
-                                if centralized_distortion_settings[distortion_type]['overlay_image']:
-                                    overlay_bytes = centralized_distortion_settings[distortion_type]['overlay_image']
-                                    distortion_params["overlay_image"] = Image.open(io.BytesIO(overlay_bytes)).convert("RGBA")
-                                else:
-                                    distortion_params["overlay_image"] = None
-                            elif distortion_type == "Color":
-                                distortion_params.update(centralized_distortion_settings[distortion_type])
-                            elif distortion_type == "Warp":
-                                distortion_params["intensity"] = centralized_distortion_settings[distortion_type]['intensity']
-                                distortion_params["warp_params"] = centralized_distortion_settings[distortion_type]['warp_params']
-                            else:
-                                distortion_params["intensity"] = centralized_distortion_settings[distortion_type]['intensity']
-                            distortions_list.append(distortion_params)
-                    else:
-                        settings = st.session_state.image_settings[i]
-                        for distortion_type in settings['distortions']:
-                            distortion_params = {"type": distortion_type}
-                            if distortion_type == "Color":
-                                distortion_params["saturation"] = settings.get(f"{distortion_type}_saturation", 1.0)
-                                distortion_params["hue_shift"] = settings.get(f"{distortion_type}_hue_shift", 0.0)
-                            elif distortion_type == "Overlay":
-                                distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
-                                overlay_image_bytes = settings.get(f"{distortion_type}_overlay_image")
-                                if overlay_image_bytes:
-                                    distortion_params["overlay_image"] = Image.open(io.BytesIO(overlay_image_bytes)).convert("RGBA")
-                                else:
-                                    distortion_params["overlay_image"] = None
-                            elif distortion_type == "Warp":
-                                distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
-                                distortion_params["warp_params"] = {
-                                    "wave_amplitude": settings.get(f"{distortion_type}_wave_amplitude", 20.0),
-                                    "wave_frequency": settings.get(f"{distortion_type}_wave_frequency", 0.04),
-                                    "bulge_factor": settings.get(f"{distortion_type}_bulge_factor", 30.0)
-                                }
-                            else:
-                                distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
-                            distortions_list.append(distortion_params)
-
-                    # Only apply distortions if there are valid distortions to apply
-                    if any(d for d in distortions_list if d.get("overlay_image") is not None or d["type"] != "Overlay"):
-                        processed_image = apply_distortions(image, distortions_list)
-                    else:
-                        processed_image = image
-
-                    # Modify this part to include intensity information
-                    distortions_info = []
-                    for d in distortions_list:
-                        if d['type'] == 'Color':
-                            distortions_info.append(f"{d['type']} (Saturation: {d['saturation']:.2f}, Hue Shift: {d['hue_shift']:.2f})")
-                        elif d['type'] == 'Warp':
-                            distortions_info.append(f"{d['type']} (Intensity: {d['intensity']:.2f}, Wave Amp: {d['warp_params']['wave_amplitude']:.2f}, Wave Freq: {d['warp_params']['wave_frequency']:.2f}, Bulge: {d['warp_params']['bulge_factor']:.2f})")
-                        else:
-                            distortions_info.append(f"{d['type']} (Intensity: {d['intensity']:.2f})")
-
-                    # Get AI response
-                    text_response, json_response = get_gemini_response(
-                        settings["input_text"],
-                        processed_image,
-                        st.session_state.model_choice,
-                        st.session_state.system_instructions if st.session_state.use_system_instructions else None,
-                        EXPECTED_JSON_FIELDS  # Add this line
-                    )
-
-                    # Create a result dictionary with basic info
-                    result = {
-                        "Image": file_name,
-                        "Distortions": ', '.join(distortions_info),
-                        "Input Text": settings["input_text"],
-                        "AI Response": text_response,
-                        "JSON Response": json.dumps(json_response, indent=2)
-                    }
-
-                    # Add result to list
-                    results.append(result)
-
-                    # Show AI response
-                    st.write(f"AI Response for {file_name}:")
-                    st.write(text_response)
-
-                    st.markdown("---")  # Add a separator between images
+        bulk_concurrency = st.slider(
+            "Concurrent requests",
+            1,
+            16,
+            4,
+            help="Number of requests sent to the model at the same time. Results keep the input order."
+        )
 
-                except Exception as e:
-                    st.error(f"Error processing {file_name}: {str(e)}")
-                    st.error(traceback.format_exc())
+        cpu_workers = st.number_input(
+            "Image preparation processes",
+            min_value=0,
+            max_value=os.cpu_count() or 1,
+            value=0,
+            help="Decode, distort and encode images in separate processes while the requests above wait on the API. 0 prepares each image on its request thread; try 2-4 for heavy distortions on large images."
+        )
 
-                progress_bar.progress((i + 1) / len(uploaded_files))
+        pack_images = st.checkbox(
+            "Pack several images into one request",
+            value=False,
+            help="Consecutive images with the same prompt share a request; unparseable answers fall back to one request per image."
+        )
+        images_per_request = st.slider("Images per request", 2, 8, 4) if pack_images else 1
+
+        max_retries = st.number_input(
+            "Retries per request",
+            min_value=0,
+            max_value=10,
+            value=3,
+            help="Rate-limit, server and timeout errors are retried with exponential backoff before a row is marked as failed."
+        )
 
-            if results:
-                # Create DataFrame
-                results_df = pd.DataFrame(results)
+        results_format = st.selectbox(
+            "Results file format",
+            ["csv", "jsonl", "parquet"],
+            help=f"Rows are appended to a file in {RESULTS_DIR} as soon as they finish, so an interrupted run keeps its results. Parquet needs pyarrow."
+        )
 
-                # Add JSON fields as separate columns
-                for field in EXPECTED_JSON_FIELDS:
-                    results_df[field] = results_df['JSON Response'].apply(
-                        lambda x: json.loads(x).get(field, '')
-                    )
-                    # Check if the field contains a list and join it into a string
-                    if results_df[field].dtype == 'object':
-                        results_df[field] = results_df[field].apply(
-                            lambda x: ', '.join(x) if isinstance(x, list) else x
-                        )
+        resume_bulk_run = st.checkbox(
+            "Resume interrupted runs",
+            value=True,
+            help="Skip images already finished by an earlier run with the same images and settings. Untick to start over."
+        )
 
-                # Remove empty columns
-                results_df = results_df.dropna(axis=1, how='all')
+        # Button to start bulk analysis
+        if st.button("Run Bulk Analysis") and uploaded_files:
+            progress_bar = st.progress(0)
 
-                # Remove columns that are entirely empty strings
-                results_df = results_df.loc[:, (results_df != '').any()]
+            # Collect everything the workers need up front; Streamlit state is only touched here
+            bulk_jobs = []
+            for i, file in enumerate(uploaded_files):
+                file_name = file.name if hasattr(file, 'name') else os.path.relpath(file, folder_path)
+                settings = st.session_state.image_settings.get(i) or default_image_settings()
+
+                # Apply distortions
+                distortions_list = []
+                if use_centralized_distortions:
+                    for distortion_type in centralized_distortions:
+                        distortion_params = {"type": distortion_type}
+                        if distortion_type == "Overlay":
+                            distortion_params["intensity"] = centralized_distortion_settings[distortion_type]['intensity']
+                            # The PNG bytes are passed as they are; the decoded, resized overlay is cached by utils
+                            distortion_params["overlay_image"] = centralized_distortion_settings[distortion_type]['overlay_image'] or None
+                        elif distortion_type == "Color":
+                            distortion_params.update(centralized_distortion_settings[distortion_type])
+                        elif distortion_type == "Warp":
+                            distortion_params["intensity"] = centralized_distortion_settings[distortion_type]['intensity']
+                            distortion_params["warp_params"] = centralized_distortion_settings[distortion_type]['warp_params']
+                            distortion_params["tiled"] = st.session_state.low_memory_warp
+                        else:
+                            distortion_params.update(centralized_distortion_settings[distortion_type])
+                        distortions_list.append(distortion_params)
+                else:
+                    for distortion_type in settings['distortions']:
+                        distortion_params = {"type": distortion_type}
+                        if distortion_type == "Color":
+                            distortion_params["saturation"] = settings.get(f"{distortion_type}_saturation", 1.0)
+                            distortion_params["hue_shift"] = settings.get(f"{distortion_type}_hue_shift", 0.0)
+                        elif distortion_type == "Overlay":
+                            distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
+                            distortion_params["overlay_image"] = settings.get(f"{distortion_type}_overlay_image") or None
+                        elif distortion_type == "Warp":
+                            distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
+                            distortion_params["warp_params"] = {
+                                "wave_amplitude": settings.get(f"{distortion_type}_wave_amplitude", 20.0),
+                                "wave_frequency": settings.get(f"{distortion_type}_wave_frequency", 0.04),
+                                "bulge_factor": settings.get(f"{distortion_type}_bulge_factor", 30.0)
+                            }
+                            distortion_params["tiled"] = st.session_state.low_memory_warp
+                        else:
+                            distortion_params["intensity"] = settings.get(f"{distortion_type}_intensity", 0.5)
+                            if distortion_type == "Rain":
+                                # Seeded so runs are reproducible and each rain layer is reused
+                                distortion_params["seed"] = settings.get(f"{distortion_type}_seed", 0)
+                                distortion_params["variants"] = settings.get(f"{distortion_type}_variants", 1)
+                        distortions_list.append(distortion_params)
+
+                bulk_jobs.append({
+                    "file": file,
+                    "file_name": file_name,
+                    "distortions": assign_rain_variants(distortions_list, i),
+                    "input_text": settings["input_text"],
+                })
 
-                # Reorder columns
-                base_columns = ["Image", "Distortions", "Input Text", "AI Response", "JSON Response"]
-                json_columns = [col for col in EXPECTED_JSON_FIELDS if col in results_df.columns]
-                columns_order = base_columns + json_columns
+            # Shared by all workers: repeated transient failures pause the whole run
+            breaker = CircuitBreaker(failure_threshold=5, reset_seconds=30)
+            request_options = {
+                "cache": response_cache,
+                "refresh_cache": st.session_state.refresh_response_cache,
+                "structured_output": st.session_state.structured_output,
+                "max_retries": max_retries,
+                "breaker": breaker,
+                "max_long_edge": st.session_state.payload_max_long_edge or None,
+                "image_format": st.session_state.payload_format,
+                "quality": st.session_state.payload_quality,
+            }
+
+            system_instructions = st.session_state.system_instructions if st.session_state.use_system_instructions else None
+            config_hash = run_config_hash(
+                bulk_jobs,
+                model=st.session_state.model_choice,
+                system_instructions=system_instructions,
+                expected_fields=EXPECTED_JSON_FIELDS,
+                images_per_request=images_per_request,
+                structured_output=st.session_state.structured_output,
+                max_long_edge=request_options["max_long_edge"],
+                image_format=request_options["image_format"],
+                quality=request_options["quality"],
+            )
 
-                # Only include columns that exist in the DataFrame
-                columns_order = [col for col in columns_order if col in results_df.columns]
-                results_df = results_df[columns_order]
+            # Rows are streamed to disk in input order as they complete; the manifest next
+            # to them lets a rerun with the same configuration pick up where this one stopped
+            results_path = os.path.join(RESULTS_DIR, f"bulk_analysis_{config_hash[:16]}.{results_format}")
+            manifest = RunManifest(results_path + ".manifest.json", config_hash, len(bulk_jobs), resume=resume_bulk_run)
+            result_writer = ResultWriter(results_path, EXPECTED_JSON_FIELDS, manifest=manifest)
+            completed = manifest.next_index
+            if completed:
+                st.info(f"Resuming an interrupted run: {completed} of {len(bulk_jobs)} images already done.")
+                progress_bar.progress(completed / len(bulk_jobs))
+            bulk_run = run_bulk_analysis(
+                bulk_jobs,
+                st.session_state.model_choice,
+                system_instructions,
+                EXPECTED_JSON_FIELDS,
+                max_workers=bulk_concurrency,
+                images_per_request=images_per_request,
+                compiled=st.session_state.compiled_pipeline,
+                start_index=manifest.next_index,
+                cpu_workers=cpu_workers,
+                **request_options
+            )
+            # The performance panel follows this run
+            st.session_state.stage_timings = []
+            run_start = time.perf_counter()
+            processed = 0
+            try:
+                for unit, unit_results, error in bulk_run:
+                    for position, i in enumerate(unit):
+                        file_name = bulk_jobs[i]["file_name"]
+                        if error is None:
+                            result = unit_results[position]
+                            result_writer.add(i, result)
+                            record_stage_timings(result)
+
+                            # Show AI response
+                            st.write(f"AI Response for {file_name}:")
+                            st.write(result["AI Response"])
+
+                            st.markdown("---")  # Add a separator between images
+                        else:
+                            result_writer.add(i, None)
+                            st.error(f"Error processing {file_name}: {str(error)}")
+                            st.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+                        completed += 1
+                        processed += 1
+                    progress_bar.progress(completed / len(bulk_jobs))
+                    st.session_state.images_per_minute = processed * 60 / (time.perf_counter() - run_start)
+                    show_performance(performance_panel)
+            finally:
+                # Flushes the last Parquet row group even if the run is interrupted
+                result_writer.close()
+
+            if result_writer.rows_written:
+                results_df = read_results(results_path, EXPECTED_JSON_FIELDS)
 
                 st.subheader("Analysis Results")
                 st.dataframe(results_df)
+                st.caption(f"Results saved to {results_path}")
+
+                warp_cache_stats = get_warp_cache_stats()
+                if warp_cache_stats["hits"] or warp_cache_stats["misses"]:
+                    st.caption(f"Warp map cache: {warp_cache_stats['hits']} hits, {warp_cache_stats['misses']} misses")
+                if breaker.trips:
+                    st.warning(f"The API was unhealthy during this run; requests were paused {breaker.trips} time(s).")
 
                 # Convert DataFrame to CSV
                 csv = results_df.to_csv(index=False)
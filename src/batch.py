@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+import google.generativeai as genai
+from .utils import (
+    run_bulk_analysis,
+    run_sweep_analysis,
+    expand_distortion_grid,
+    sweep_columns,
+    assign_rain_variants,
+    stage_percentiles,
+    ResultWriter,
+    RunManifest,
+    replace_result_rows,
+    run_config_hash,
+    CircuitBreaker,
+    ResponseCache,
+    EXPECTED_JSON_FIELDS,
+    DEFAULT_SYSTEM_INSTRUCTIONS,
+    discover_images,
+)
+
+# Headless bulk analysis, e.g.
+#   python -m src.batch images/ --prompt "Identify potential hazards" \
+#       --distortions '[{"type": "Rain", "intensity": 0.5}]' --concurrency 8 --output results.csv
+# or, for every combination of a grid of settings,
+#   python -m src.batch images/ --prompt "Identify potential hazards" \
+#       --sweep '[{"type": "Blur", "intensity": [0.0, 0.5, 1.0]}, {"type": "Rain", "intensity": [0.0, 0.5]}]'
+
+DEFAULT_WARP_PARAMS = {"wave_amplitude": 20.0, "wave_frequency": 0.04, "bulge_factor": 30.0}
+
+def load_distortions(value):
+    # Accepts a JSON list of distortions, or the path of a file containing one
+    if not value:
+        return []
+    if os.path.isfile(value):
+        with open(value) as f:
+            distortions = json.load(f)
+    else:
+        distortions = json.loads(value)
+    if isinstance(distortions, dict):
+        distortions = [distortions]
+
+    # Fill in the same defaults the app uses for settings that were left out
+    for d in distortions:
+        if d["type"] == "Color":
+            d.setdefault("saturation", 1.0)
+            d.setdefault("hue_shift", 0.0)
+        else:
+            d.setdefault("intensity", 0.5)
+        if d["type"] == "Warp":
+            d["warp_params"] = {**DEFAULT_WARP_PARAMS, **d.get("warp_params", {})}
+        if d["type"] == "Overlay":
+            d.setdefault("overlay_image", None)
+        if d["type"] == "Rain":
+            # Seeded rain is reproducible across runs and workers, and each layer is made once
+            d.setdefault("seed", 0)
+    return distortions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the bulk road safety analysis without the Streamlit app.")
+    parser.add_argument("folder", help="Folder containing the images to analyse")
+    parser.add_argument("--recursive", action="store_true", help="Also analyse images in subfolders")
+    parser.add_argument("--include", action="append", default=[],
+                        help="Only analyse images matching this glob (repeatable; patterns with a / match the path inside the folder)")
+    parser.add_argument("--exclude", action="append", default=[], help="Skip images matching this glob (repeatable)")
+    parser.add_argument("--every-nth", type=int, default=1, help="Keep every Nth image, e.g. to thin out video frames")
+    parser.add_argument("--sample", type=int, help="Analyse a random sample of this many images")
+    parser.add_argument("--seed", type=int, help="Random seed for --sample")
+    parser.add_argument("--limit", type=int, help="Analyse at most this many images")
+    parser.add_argument("--prompt", default="", help="Prompt sent with every image")
+    parser.add_argument("--distortions", default="", help="JSON list of distortions, or a path to a JSON file")
+    parser.add_argument("--sweep", default="",
+                        help="JSON list (or file) of distortions where settings may be lists of values; every image is "
+                             "analysed at every combination, after the --distortions")
+    parser.add_argument("--model", default="gemini-1.5-flash-latest")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of requests sent to the model at the same time")
+    parser.add_argument("--cpu-workers", type=int, default=0,
+                        help="Processes that decode, distort and encode images ahead of the requests, e.g. 2-4 for heavy "
+                             "distortions on large images (default 0 = on the request threads)")
+    parser.add_argument("--output", default="bulk_analysis_results.csv",
+                        help="File the results are streamed to; .csv, .jsonl or .parquet (needs pyarrow)")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"),
+                        help="Gemini API key (defaults to $GEMINI_API_KEY)")
+    parser.add_argument("--system-instructions", help="File with system instructions (defaults to the app's instructions)")
+    parser.add_argument("--no-system-instructions", action="store_true")
+    parser.add_argument("--images-per-request", type=int, default=1, help="Pack several images into one request")
+    parser.add_argument("--structured-output", action="store_true", help="Request schema-constrained JSON output")
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run with the same settings instead of starting over "
+                             "(rows that failed stay failed; see --retry-failed)")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Once the run is done, analyse the failed rows again and replace them in the output")
+    parser.add_argument("--compiled", action="store_true", help="Use the fast distortion pipeline")
+    parser.add_argument("--cache", help="Path of a response cache database to reuse answers from")
+    parser.add_argument("--max-long-edge", type=int, default=0, help="Downscale images before upload (0 = original)")
+    parser.add_argument("--format", default="PNG", choices=["PNG", "JPEG", "WEBP"], help="Upload format")
+    parser.add_argument("--quality", type=int, default=85, help="Upload quality for JPEG and WEBP")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.folder):
+        print(f"Invalid folder path: {args.folder}", file=sys.stderr)
+        return 2
+    if not args.api_key:
+        print("No API key given. Use --api-key or set GEMINI_API_KEY.", file=sys.stderr)
+        return 2
+    genai.configure(api_key=args.api_key)
+
+    if args.no_system_instructions:
+        system_instructions = None
+    elif args.system_instructions:
+        with open(args.system_instructions) as f:
+            system_instructions = f.read()
+    else:
+        system_instructions = DEFAULT_SYSTEM_INSTRUCTIONS
+
+    distortions = load_distortions(args.distortions)
+    # Fixed distortions come first in every chain of a sweep, so they are computed once per image
+    chains = expand_distortion_grid(distortions + load_distortions(args.sweep)) if args.sweep else None
+    if chains and args.images_per_request > 1:
+        print("--images-per-request is ignored for sweeps", file=sys.stderr)
+    if chains and args.cpu_workers:
+        # Each image's prefix walk runs on the main thread, feeding the request threads as it goes
+        print("--cpu-workers is ignored for sweeps", file=sys.stderr)
+    images = discover_images(args.folder, recursive=args.recursive, include=args.include, exclude=args.exclude,
+                             every_nth=args.every_nth, sample=args.sample, limit=args.limit, seed=args.seed)
+    jobs = [
+        {"file": path, "file_name": os.path.relpath(path, args.folder), "distortions": assign_rain_variants(distortions, i),
+         "input_text": args.prompt}
+        for i, path in enumerate(images)
+    ]
+    if not jobs:
+        print(f"No images found in {args.folder}", file=sys.stderr)
+        return 1
+
+    request_options = {
+        "cache": ResponseCache(args.cache) if args.cache else None,
+        "structured_output": args.structured_output,
+        "max_retries": args.max_retries,
+        "breaker": CircuitBreaker(failure_threshold=5, reset_seconds=30),
+        "max_long_edge": args.max_long_edge or None,
+        "image_format": args.format,
+        "quality": args.quality,
+    }
+
+    config_hash = run_config_hash(jobs, model=args.model, system_instructions=system_instructions,
+                                  expected_fields=EXPECTED_JSON_FIELDS, images_per_request=args.images_per_request,
+                                  structured_output=args.structured_output, max_long_edge=request_options["max_long_edge"],
+                                  image_format=args.format, quality=args.quality,
+                                  sweep=[chain for chain, _ in chains] if chains else None)
+    total = len(jobs) * len(chains) if chains else len(jobs)
+    manifest = RunManifest(args.output + ".manifest.json", config_hash, total, resume=args.resume)
+
+    # Rows are appended to the output in input order as soon as they complete
+    start = time.perf_counter()
+    timed_rows = []
+    with ResultWriter(args.output, EXPECTED_JSON_FIELDS, manifest=manifest,
+                      extra_columns=sweep_columns(chains) if chains else ()) as writer:
+        completed = manifest.next_index
+        failed = sum(status in ("failed", "error") for status in manifest.statuses[:completed])
+        if completed:
+            print(f"Resuming: {completed} of {total} {'rows' if chains else 'images'} already done")
+        if chains:
+            print(f"Sweeping {len(chains)} settings per image")
+            bulk_run = run_sweep_analysis(jobs, chains, args.model, system_instructions, EXPECTED_JSON_FIELDS,
+                                          max_workers=args.concurrency, compiled=args.compiled,
+                                          start_index=manifest.next_index, **request_options)
+        else:
+            bulk_run = run_bulk_analysis(jobs, args.model, system_instructions, EXPECTED_JSON_FIELDS,
+                                         max_workers=args.concurrency, images_per_request=args.images_per_request,
+                                         compiled=args.compiled, start_index=manifest.next_index,
+                                         cpu_workers=args.cpu_workers, **request_options)
+        for unit, unit_results, error in bulk_run:
+            for position, i in enumerate(unit):
+                completed += 1
+                job = jobs[i // len(chains)] if chains else jobs[i]
+                if error is None:
+                    writer.add(i, unit_results[position])
+                    timed_rows.append(unit_results[position])
+                    failed += unit_results[position]["Status"] == "failed"
+                    print(f"[{completed}/{total}] {job['file_name']}: {unit_results[position]['Status']}")
+                else:
+                    writer.add(i, None)
+                    failed += 1
+                    print(f"[{completed}/{total}] Error processing {job['file_name']}: {str(error)}", file=sys.stderr)
+            if error is not None:
+                traceback.print_exception(type(error), error, error.__traceback__)
+
+    if args.retry_failed:
+        failed = retry_failed_rows(args, jobs, chains, manifest, system_instructions, request_options, timed_rows)
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {writer.rows_written} rows to {args.output} in {elapsed:.1f}s")
+    if timed_rows:
+        print(f"{len(timed_rows) * 60 / elapsed:.1f} rows/min; seconds per stage:")
+        print(stage_percentiles(timed_rows).round(3).to_string())
+    return 1 if failed else 0
+
+def retry_failed_rows(args, jobs, chains, manifest, system_instructions, request_options, timed_rows):
+    # Runs the rows that failed (or errored) again and swaps the new rows into the finished
+    # output. Sweeps rerun the whole image and keep only the rows that had failed.
+    retry = [i for i, status in enumerate(manifest.statuses) if status in ("failed", "error")]
+    if not retry:
+        return 0
+    print(f"Retrying {len(retry)} failed {'rows' if chains else 'images'}")
+    width = len(chains) if chains else 1
+    images = sorted({i // width for i in retry})
+    retry_jobs = [jobs[i] for i in images]
+    if chains:
+        bulk_run = run_sweep_analysis(retry_jobs, chains, args.model, system_instructions, EXPECTED_JSON_FIELDS,
+                                      max_workers=args.concurrency, compiled=args.compiled, **request_options)
+    else:
+        bulk_run = run_bulk_analysis(retry_jobs, args.model, system_instructions, EXPECTED_JSON_FIELDS,
+                                     max_workers=args.concurrency, images_per_request=args.images_per_request,
+                                     compiled=args.compiled, cpu_workers=args.cpu_workers, **request_options)
+    retry = set(retry)
+    replacements = {}
+    for unit, unit_results, error in bulk_run:
+        for position, i in enumerate(unit):
+            index = images[i // width] * width + i % width
+            if index not in retry:
+                continue
+            job = jobs[index // width]
+            if error is None:
+                replacements[index] = unit_results[position]
+                timed_rows.append(unit_results[position])
+                print(f"[retry] {job['file_name']}: {unit_results[position]['Status']}")
+            else:
+                print(f"[retry] Error processing {job['file_name']}: {str(error)}", file=sys.stderr)
+    replace_result_rows(args.output, manifest, replacements, EXPECTED_JSON_FIELDS,
+                        extra_columns=sweep_columns(chains) if chains else ())
+    return sum(status in ("failed", "error") for status in manifest.statuses)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,28 @@
-from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageOps
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
 import random
 import google.generativeai as genai
 import io
 import numpy as np
+import pandas as pd
 from scipy.ndimage import map_coordinates
 import traceback
+import contextlib
 import json
+import csv
 import re
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import queue
+import fnmatch
+import itertools
+import shutil
+from google.api_core import exceptions as api_exceptions
 
 def apply_distortion(image, type, **params):
     print(f"Applying distortion: {type}")  # Debug print
@@ -32,46 +48,207 @@ def apply_distortion(image, type, **params):
         enhancer = ImageEnhance.Sharpness(image)
         return enhancer.enhance(1 + (params.get("intensity", 0) * 4))
     elif type == "Rain":
-        return apply_rain_effect(image, params.get("intensity", 0))
+        return apply_rain_effect(image, params.get("intensity", 0), params.get("seed"), params.get("fast", False),
+                                 params.get("scale", 1.0), params.get("variant", 0))
     elif type == "Overlay":
         return apply_overlay(image, params.get("intensity", 0), params.get("overlay_image", None))
     elif type == "Warp":
-        return apply_warp_effect(image, params.get("intensity", 0), params.get("warp_params", None))
+        return apply_warp_effect(image, params.get("intensity", 0), params.get("warp_params", None), params.get("tiled", False))
     return image
 
 def shift_hue(image, amount):
     img_hsv = image.convert('HSV')
-    h, s, v = img_hsv.split()
-    h = h.point(lambda x: (x + amount * 255) % 255)
-    return Image.merge('HSV', (h, s, v)).convert('RGB')
+    # Shift the hue band with one table, leaving saturation and value untouched
+    hue = [(x + amount * 255) % 255 for x in range(256)]
+    return img_hsv.point(hue + list(range(256)) * 2).convert('RGB')
 
-def apply_rain_effect(image, intensity):
-    overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(overlay)
+def adjust_saturation(image, factor):
+    # ImageEnhance.Color (a blend with the greyscale image) as a single 3x3 matrix pass instead
+    # of converting to L, back to RGB and blending. It skips the L image's rounding, so it is
+    # only within 1 level of the blend, and a following hue shift can widen that; only the
+    # opt-in compiled pipeline uses it.
+    if image.mode != "RGB":
+        return ImageEnhance.Color(image).enhance(factor)
+    weights = (0.299, 0.587, 0.114)  # The L conversion's luma weights
+    matrix = []
+    for channel in range(3):
+        matrix += [(1 - factor) * weights[k] + (factor if k == channel else 0) for k in range(3)] + [0]
+    return image.convert("RGB", tuple(matrix))
 
+COLOR_DISTORTIONS = ("Brightness", "Contrast", "Color")
+
+def apply_color_adjustments(image, distortions):
+    # Colour engine of the compiled pipeline: folds a run of Brightness / Contrast / Color
+    # steps into as few pixel passes as possible. Brightness and contrast changes are composed into one point
+    # table, saturation is a single matrix pass and a hue shift a single HSV table.
+    # Saturation and hue cannot join the point table: the point table clips every channel
+    # to 0-255 on its own, so a matrix applied before or after it gives different colours
+    # near black and white, and PIL's HSV hue has no RGB matrix equivalent.
+    image = image if image.mode == "RGB" else image.convert("RGB")
+    pending = None  # Composed point table that has not been applied yet
+    histogram = None  # RGB histogram of `image`, taken before `pending`
+
+    for distortion in distortions:
+        params = {key: value for key, value in distortion.items() if key != "type"}
+        if distortion["type"] == "Brightness":
+            pending = _compose_lut(pending, _blend_lut(np.float32(0), 1 + params.get("intensity", 0)))
+        elif distortion["type"] == "Contrast":
+            if pending is None:
+                # Nothing pending, so the exact mean costs the same as an estimate
+                luminance = image.convert("L").histogram()
+                mean = int(np.dot(luminance, np.arange(256)) / sum(luminance) + 0.5)
+            else:
+                if histogram is None:
+                    histogram = image.histogram()
+                mean = _estimated_mean_luminance(histogram, pending)
+            pending = _compose_lut(pending, _blend_lut(np.float32(mean), 1 + params.get("intensity", 0)))
+        elif distortion["type"] == "Color":
+            if "saturation" not in params and "hue_shift" not in params:
+                continue
+            image = _apply_lut(image, pending)
+            pending = None
+            histogram = None
+            if "saturation" in params and "hue_shift" in params:
+                # The HSV round trip magnifies the matrix's rounding, so the exact blend is kept
+                image = ImageEnhance.Color(image).enhance(params["saturation"])
+            elif "saturation" in params:
+                image = adjust_saturation(image, params["saturation"])
+            if "hue_shift" in params:
+                image = shift_hue(image, params["hue_shift"])
+    return _apply_lut(image, pending)
+
+def _blend_lut(degenerate, factor):
+    # Per-channel table equivalent to Image.blend(degenerate, image, factor)
+    if factor == 1.0:
+        return None
+    values = degenerate + np.float32(factor) * (np.arange(256, dtype=np.float32) - degenerate)
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+def _compose_lut(first, second):
+    if first is None or second is None:
+        return second if first is None else first
+    return second[first]
+
+def _apply_lut(image, lut):
+    if lut is None:
+        return image
+    return image.point(lut.tolist() * len(image.getbands()))
+
+def _estimated_mean_luminance(histogram, lut):
+    # Mean of L after `lut`, from the per-channel histograms instead of another pass
+    counts = np.array(histogram, dtype=np.float64).reshape(-1, 256)[:3]
+    means = counts @ lut.astype(np.float64) / counts[0].sum()
+    return int((19595 * means[0] + 38470 * means[1] + 7471 * means[2]) / 65536 + 0.5)
+
+def apply_rain_effect(image, intensity, seed=None, fast=False, scale=1.0, variant=0):
+    # scale shrinks streaks and their blur for downscaled proxies (see scale_distortions).
+    # Seeded rain layers are cached (see _rain_layer); variant picks another layer from the same seed.
     width, height = image.size
-    for _ in range(int(intensity * 1000)):
-        x = random.randint(0, width)
-        y = random.randint(0, height)
-        length = random.randint(10, 20)
-        draw.line((x, y, x + random.randint(-2, 2), y + length), fill=(255, 255, 255, random.randint(50, 150)), width=1)
-    
-    rain_overlay = overlay.filter(ImageFilter.GaussianBlur(1))
-    return Image.alpha_composite(image.convert("RGBA"), rain_overlay).convert("RGB")
+    layer = _rain_layer(width, height, intensity, seed, scale, variant)
+
+    if not fast and (image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info):
+        # Transparent images keep PIL's compositing
+        covered, weights = layer
+        alpha = np.zeros(width * height, dtype=np.uint8)
+        alpha[covered] = weights[:, 0]
+        rain_overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))
+        rain_overlay.putalpha(Image.fromarray(alpha.reshape(height, width), mode='L'))
+        return Image.alpha_composite(image.convert("RGBA"), rain_overlay).convert("RGB")
+
+    # Blend white rain straight into the RGB pixels; for opaque images this is exactly
+    # what alpha compositing a white RGBA layer gives
+    rgb = np.array(image if image.mode == "RGB" else image.convert("RGB"))
+    _blend_rain_layer(rgb, layer)
+    return Image.fromarray(rgb, mode='RGB')
+
+def assign_rain_variants(distortions, index):
+    # Rain steps with "variants": n get variant index % n, so consecutive frames of a bulk
+    # run rotate through n cached rain layers instead of all showing the same one
+    return [
+        {**d, "variant": index % d["variants"]} if d["type"] == "Rain" and d.get("variants", 1) > 1 else d
+        for d in distortions
+    ]
+
+def _rain_layer(width, height, intensity, seed=None, scale=1.0, variant=0):
+    # The blurred rain alpha as (flat indices of the covered pixels, their alpha as uint16).
+    # Seeded layers are the same in every process and are cached, so frames of the same size
+    # and settings only pay for the blend; unseeded rain is drawn afresh every time.
+    key = None
+    if seed is not None:
+        key = (width, height, intensity, seed, scale, variant)
+        layer = _RAIN_LAYER_CACHE.get(key)
+        if layer is not None:
+            return layer
+        if variant:
+            seed = [seed, variant]
+    alpha = np.asarray(_rain_alpha_layer(width, height, intensity, seed, scale)).ravel()
+    covered = np.flatnonzero(alpha)
+    layer = (covered, alpha[covered].astype(np.uint16)[:, None])
+    return layer if key is None else _RAIN_LAYER_CACHE.put(key, layer)
+
+def _rain_alpha_layer(width, height, intensity, seed, scale=1.0):
+    rng = np.random.default_rng(seed)
+
+    # Generate every streak at once and rasterize them into a single alpha layer
+    streaks = _generate_rain_streaks(width, height, intensity, rng)
+    if scale != 1.0:
+        # Streaks cannot get thinner than a pixel, so they are made fainter instead
+        xs, ys, lengths, slants, alphas = streaks
+        lengths = np.maximum(1, np.rint(lengths * scale)).astype(lengths.dtype)
+        slants = np.rint(slants * scale).astype(slants.dtype)
+        alphas = np.clip(np.rint(alphas * min(scale, 1.0)), 1, 255).astype(np.uint8)
+        streaks = (xs, ys, lengths, slants, alphas)
+    alpha = _rasterize_rain_streaks(width, height, streaks)
+    return Image.fromarray(alpha, mode='L').filter(ImageFilter.GaussianBlur(scale))
+
+def _generate_rain_streaks(width, height, intensity, rng):
+    count = int(intensity * 1000)
+    xs = rng.integers(0, width, count, endpoint=True)
+    ys = rng.integers(0, height, count, endpoint=True)
+    lengths = rng.integers(10, 20, count, endpoint=True)
+    slants = rng.integers(-2, 2, count, endpoint=True)
+    alphas = rng.integers(50, 150, count, endpoint=True).astype(np.uint8)
+    return xs, ys, lengths, slants, alphas
+
+def _rasterize_rain_streaks(width, height, streaks):
+    xs, ys, lengths, slants, alphas = streaks
+    layer = np.zeros((height, width), dtype=np.uint8)
+    if len(xs) == 0:
+        return layer
+
+    # One row per streak, one column per step along the streak
+    steps = np.arange(lengths.max() + 1)[None, :]
+    px = xs[:, None] + np.rint(slants[:, None] * steps / lengths[:, None]).astype(np.int64)
+    py = ys[:, None] + steps
+    visible = (steps <= lengths[:, None]) & (px >= 0) & (px < width) & (py < height)
+
+    # Later streaks overwrite earlier ones, as with sequential line drawing
+    layer[py[visible], px[visible]] = np.broadcast_to(alphas[:, None], px.shape)[visible]
+    return layer
+
+def _blend_rain_layer(rgb, layer):
+    # Rain only covers a small part of the frame, so only touch the covered pixels
+    covered, weights = layer
+    flat = rgb.reshape(-1, 3)
+    pixels = flat[covered].astype(np.uint16)
+    flat[covered] = pixels + ((255 - pixels) * weights + 127) // 255
 
 def apply_overlay(image, intensity, overlay_image):
     if overlay_image is None:
         return image
     
     try:
-        if isinstance(overlay_image, (bytes, io.BytesIO)):
-            overlay = Image.open(io.BytesIO(overlay_image)).convert("RGBA")
-        elif isinstance(overlay_image, Image.Image):
-            overlay = overlay_image.convert("RGBA")
-        elif isinstance(overlay_image, str):
-            overlay = Image.open(overlay_image).convert("RGBA")
-        else:
-            print(f"Unsupported overlay_image type: {type(overlay_image)}")
+        if image.mode not in ("RGBA", "LA", "PA") and "transparency" not in image.info:
+            # Opaque images (the usual case) are blended with the cached, pre-faded overlay
+            prepared = _prepared_overlay(overlay_image, image.size, intensity)
+            if prepared is None:
+                return image
+            pixels = np.array(image.convert("RGB"))
+            _composite_overlay(pixels, prepared)
+            return Image.fromarray(pixels, mode="RGB")
+
+        overlay = _load_overlay(overlay_image)
+        if overlay is None:
             return image
         
         overlay = overlay.resize(image.size)
@@ -92,39 +269,32 @@ def apply_overlay(image, intensity, overlay_image):
         traceback.print_exc()
         return image  # Return the original image if there's an error
 
-def apply_warp_effect(image, intensity, warp_params):
+def _load_overlay(overlay_image):
+    if isinstance(overlay_image, bytes):
+        return Image.open(io.BytesIO(overlay_image)).convert("RGBA")
+    elif isinstance(overlay_image, io.BytesIO):
+        return Image.open(overlay_image).convert("RGBA")
+    elif isinstance(overlay_image, Image.Image):
+        return overlay_image.convert("RGBA")
+    elif isinstance(overlay_image, str):
+        return Image.open(overlay_image).convert("RGBA")
+    print(f"Unsupported overlay_image type: {type(overlay_image)}")
+    return None
+
+def apply_warp_effect(image, intensity, warp_params, tiled=False, tile_rows=None):
     try:
+        if tiled:
+            return _apply_warp_tiled(image, intensity, warp_params, tile_rows)
+
         img = np.array(image)
         rows, cols = img.shape[0], img.shape[1]
         
-        # Create meshgrid
-        src_cols, src_rows = np.meshgrid(np.linspace(0, cols-1, cols), np.linspace(0, rows-1, rows))
-        
-        # Wave effect
-        wave_amplitude = warp_params.get('wave_amplitude', 20) * intensity
-        wave_frequency = warp_params.get('wave_frequency', 0.05) * 10  # Increase frequency impact
-        dst_rows = src_rows + np.sin(src_cols * wave_frequency) * wave_amplitude
-        dst_cols = src_cols + np.sin(src_rows * wave_frequency) * wave_amplitude
-        
-        # Bulge/Pinch effect
-        center_row, center_col = rows // 2, cols // 2
-        dist_from_center = np.sqrt((src_rows - center_row)**2 + (src_cols - center_col)**2)
-        
-        bulge_factor = warp_params.get('bulge_factor', 30) * intensity * 2  # Increase bulge impact
-        max_dist = np.sqrt(center_row**2 + center_col**2)
-        
-        # Normalize distances
-        dist_from_center = dist_from_center / max_dist
-        
-        # Apply bulge/pinch
-        factor = (1 - dist_from_center**2) * bulge_factor
-        dst_rows += (src_rows - center_row) * factor / (rows / 4)  # Increase effect
-        dst_cols += (src_cols - center_col) * factor / (cols / 4)  # Increase effect
+        coordinates = _cached_warp_coordinates(rows, cols, intensity, warp_params)
         
         # Map coordinates
         warped = np.zeros_like(img)
         for i in range(min(3, img.shape[2])):  # Handle both RGB and RGBA
-            warped[:,:,i] = map_coordinates(img[:,:,i], [dst_rows, dst_cols], order=1, mode='reflect')
+            warped[:,:,i] = map_coordinates(img[:,:,i], coordinates, order=1, mode='reflect')
         
         if img.shape[2] == 4:  # If RGBA, copy the alpha channel
             warped[:,:,3] = img[:,:,3]
@@ -137,15 +307,573 @@ def apply_warp_effect(image, intensity, warp_params):
         print(traceback.format_exc())
         return image  # Return the original image if there's an error
 
-def apply_distortions(image, distortions):
+def _apply_warp_tiled(image, intensity, warp_params, tile_rows=None):
+    # Low-memory warp: coordinates are built per strip of rows in float32 by broadcasting
+    # a row vector against a column vector, and each strip gathers straight from the source,
+    # so peak memory is the input, the output and one strip of temporaries.
+    img = np.asarray(image)
+    warped = np.empty_like(img)
+    colour = img if img.ndim == 2 else img[:, :, :3]
+    _warp_strips(colour, intensity, warp_params, warped if img.ndim == 2 else warped[:, :, :3], tile_rows)
+    if img.ndim == 3 and img.shape[2] == 4:  # If RGBA, copy the alpha channel
+        warped[:, :, 3] = img[:, :, 3]
+    return Image.fromarray(warped, mode=image.mode)
+
+def _warp_strips(img, intensity, warp_params, out, tile_rows=None):
+    rows, cols = img.shape[0], img.shape[1]
+    if tile_rows is None:
+        tile_rows = max(1, (1 << 16) // cols)  # About 64k pixels per strip
+
+    wave_amplitude = warp_params.get('wave_amplitude', 20) * intensity
+    wave_frequency = warp_params.get('wave_frequency', 0.05) * 10
+    bulge_factor = warp_params.get('bulge_factor', 30) * intensity * 2
+    center_row, center_col = rows // 2, cols // 2
+    max_dist_sq = (center_row**2 + center_col**2) or 1
+
+    # Everything that only depends on the column is computed once for all strips
+    src_cols = np.arange(cols, dtype=np.float32)[None, :]
+    col_offset = src_cols - center_col
+    col_wave = np.sin(src_cols * wave_frequency) * wave_amplitude
+    col_dist_sq = col_offset**2 / max_dist_sq
+
+    for start in range(0, rows, tile_rows):
+        stop = min(start + tile_rows, rows)
+        src_rows = np.arange(start, stop, dtype=np.float32)[:, None]
+        row_offset = src_rows - center_row
+        factor = (1 - (row_offset**2 / max_dist_sq + col_dist_sq)) * bulge_factor
+        dst_rows = src_rows + col_wave + row_offset * factor / (rows / 4)
+        dst_cols = src_cols + np.sin(src_rows * wave_frequency) * wave_amplitude + col_offset * factor / (cols / 4)
+        _bilinear_reflect(img, dst_rows, dst_cols, out[start:stop])
+
+def _reflect_index(index, size):
+    # Half-sample reflection, the 'reflect' boundary mode of scipy.ndimage
+    index = np.where(index < 0, -1 - index, index)
+    if index.max(initial=0) >= size:
+        index = np.mod(index, 2 * size)
+        index = np.where(index >= size, 2 * size - 1 - index, index)
+    return index
+
+def _bilinear_reflect(img, dst_rows, dst_cols, out):
+    # Linear interpolation of all channels in one gather; equivalent to
+    # map_coordinates(order=1, mode='reflect') applied channel by channel
+    rows, cols = img.shape[0], img.shape[1]
+    top = np.floor(dst_rows)
+    left = np.floor(dst_cols)
+    row_weight = dst_rows - top
+    col_weight = dst_cols - left
+    if img.ndim == 3:
+        row_weight = row_weight[:, :, None]
+        col_weight = col_weight[:, :, None]
+    top = top.astype(np.intp)
+    left = left.astype(np.intp)
+    top, bottom = _reflect_index(top, rows) * cols, _reflect_index(top + 1, rows) * cols
+    left, right = _reflect_index(left, cols), _reflect_index(left + 1, cols)
+
+    flat = img.reshape((rows * cols,) + img.shape[2:])
+    upper = flat[top + left] * (1 - col_weight)
+    upper += flat[top + right] * col_weight
+    lower = flat[bottom + left] * (1 - col_weight)
+    lower += flat[bottom + right] * col_weight
+    upper *= 1 - row_weight
+    lower *= row_weight
+    upper += lower
+    np.rint(upper, out=upper)
+    np.copyto(out, upper, casting='unsafe')
+
+class _LRUCache:
+    # Thread-safe LRU cache of NumPy arrays (or tuples of them), bounded by total bytes.
+    # Other values can be stored by passing their size to put().
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = sum(array.nbytes for array in (value if isinstance(value, tuple) else (value,)))
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._evict()
+        return value
+
+    def set_limit(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            self._bytes -= self._entries.popitem(last=False)[1][1]
+
+# Remap tables for Warp, shared by every image with the same size and warp settings
+_WARP_MAP_CACHE = _LRUCache(max_bytes=512 * 1024 * 1024)
+
+def get_warp_cache_stats():
+    return _WARP_MAP_CACHE.stats()
+
+def set_warp_cache_limit(max_bytes):
+    _WARP_MAP_CACHE.set_limit(max_bytes)
+
+def clear_warp_cache():
+    _WARP_MAP_CACHE.clear()
+
+# Rain layers, shared by every frame with the same size and seeded rain settings
+_RAIN_LAYER_CACHE = _LRUCache(max_bytes=128 * 1024 * 1024)
+
+def get_rain_cache_stats():
+    return _RAIN_LAYER_CACHE.stats()
+
+def clear_rain_cache():
+    _RAIN_LAYER_CACHE.clear()
+
+# Overlays resized to a frame size and faded by an intensity, shared by every image in a bulk run
+_OVERLAY_CACHE = _LRUCache(max_bytes=256 * 1024 * 1024)
+
+def get_overlay_cache_stats():
+    return _OVERLAY_CACHE.stats()
+
+def clear_overlay_cache():
+    _OVERLAY_CACHE.clear()
+
+def _overlay_key(overlay_image):
+    if isinstance(overlay_image, (bytes, bytearray)):
+        return ("bytes", hashlib.sha256(overlay_image).hexdigest())
+    if isinstance(overlay_image, io.BytesIO):
+        return ("bytes", hashlib.sha256(overlay_image.getvalue()).hexdigest())
+    if isinstance(overlay_image, Image.Image):
+        return ("image", overlay_image.mode, overlay_image.size, hashlib.sha256(overlay_image.tobytes()).hexdigest())
+    if isinstance(overlay_image, str):
+        return image_identity(overlay_image)
+    return None
+
+def _prepared_overlay(overlay_image, size, intensity):
+    # The overlay resized to size and faded by intensity, stored as (colour * alpha, 255 - alpha)
+    # in uint16 so that compositing it is a single integer blend
+    key = _overlay_key(overlay_image)
+    if key is not None:
+        key = (key, size, intensity)
+        prepared = _OVERLAY_CACHE.get(key)
+        if prepared is not None:
+            return prepared
+
+    overlay = _load_overlay(overlay_image)
+    if overlay is None:
+        return None
+    # Same rounding as Image.blend against a transparent image: float32 product, truncated
+    faded = np.asarray(overlay.resize(size), dtype=np.float32) * np.float32(intensity)
+    faded = np.clip(faded, 0, 255).astype(np.uint16)
+    alpha = faded[:, :, 3:]
+    prepared = (faded[:, :, :3] * alpha, 255 - alpha)
+    if key is None:
+        return prepared
+    return _OVERLAY_CACHE.put(key, prepared)
+
+def _composite_overlay(pixels, prepared, scratch=None):
+    # In-place equivalent of Image.alpha_composite over an opaque image:
+    # out = (t + 128 + ((t + 128) >> 8)) >> 8 with t = colour * alpha + pixel * (255 - alpha)
+    premultiplied, inverse = prepared
+    blended = np.multiply(pixels, inverse, out=scratch, dtype=np.uint16)
+    blended += premultiplied
+    blended += 128
+    np.right_shift(blended, 8, out=pixels, casting='unsafe')
+    blended += pixels
+    np.right_shift(blended, 8, out=pixels, casting='unsafe')
+    return pixels
+
+def _cached_warp_coordinates(rows, cols, intensity, warp_params):
+    key = (
+        rows,
+        cols,
+        intensity,
+        warp_params.get('wave_amplitude', 20),
+        warp_params.get('wave_frequency', 0.05),
+        warp_params.get('bulge_factor', 30),
+    )
+    coordinates = _WARP_MAP_CACHE.get(key)
+    if coordinates is None:
+        coordinates = np.array(_warp_coordinates(rows, cols, intensity, warp_params))
+        coordinates.setflags(write=False)
+        _WARP_MAP_CACHE.put(key, coordinates)
+    return coordinates
+
+def _warp_coordinates(rows, cols, intensity, warp_params):
+    # Create meshgrid
+    src_cols, src_rows = np.meshgrid(np.linspace(0, cols-1, cols), np.linspace(0, rows-1, rows))
+    
+    # Wave effect
+    wave_amplitude = warp_params.get('wave_amplitude', 20) * intensity
+    wave_frequency = warp_params.get('wave_frequency', 0.05) * 10  # Increase frequency impact
+    dst_rows = src_rows + np.sin(src_cols * wave_frequency) * wave_amplitude
+    dst_cols = src_cols + np.sin(src_rows * wave_frequency) * wave_amplitude
+    
+    # Bulge/Pinch effect
+    center_row, center_col = rows // 2, cols // 2
+    dist_from_center = np.sqrt((src_rows - center_row)**2 + (src_cols - center_col)**2)
+    
+    bulge_factor = warp_params.get('bulge_factor', 30) * intensity * 2  # Increase bulge impact
+    max_dist = np.sqrt(center_row**2 + center_col**2)
+    
+    # Normalize distances
+    dist_from_center = dist_from_center / max_dist
+    
+    # Apply bulge/pinch
+    factor = (1 - dist_from_center**2) * bulge_factor
+    dst_rows += (src_rows - center_row) * factor / (rows / 4)  # Increase effect
+    dst_cols += (src_cols - center_col) * factor / (cols / 4)  # Increase effect
+    return dst_rows, dst_cols
+
+def apply_distortions(image, distortions, compiled=False):
+    if compiled:
+        return compile_distortions(distortions)(image)
     for distortion in distortions:
         image = apply_distortion(image, **distortion)
     return image
 
-def get_gemini_response(input_text, image, model_name, system_instructions, expected_fields):
-    model = genai.GenerativeModel(model_name)
-    response = None
-    
+# Compiled pipeline: the image is held in one RGB uint8 NumPy buffer that is reused
+# (together with its scratch arrays) for the whole chain. Rain, Overlay and Warp update
+# the buffer in place. Steps PIL already runs fastest in C (point tables, enhance,
+# filters) work on a PIL view and the buffer is only refreshed when a NumPy step needs
+# it again, so consecutive PIL steps or NumPy steps never convert in between.
+
+class _WorkingBuffer:
+    def __init__(self, image):
+        self._image = image if image.mode == "RGB" else image.convert("RGB")
+        self._pixels = None
+        self._stale = True
+        self._scratch = {}
+
+    @property
+    def size(self):
+        return self._image.size if self._image is not None else self._pixels.shape[1::-1]
+
+    def scratch(self, name, shape, dtype):
+        array = self._scratch.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = np.empty(shape, dtype=dtype)
+            self._scratch[name] = array
+        return array
+
+    def pixels(self):
+        if self._stale:
+            if self._pixels is None or self._pixels.shape[1::-1] != self._image.size:
+                self._pixels = np.array(self._image)
+            else:
+                np.copyto(self._pixels, np.asarray(self._image))
+            self._stale = False
+        self._image = None
+        return self._pixels
+
+    def swap_pixels(self, name):
+        # Exchange the buffer with a scratch array of the same shape (for out-of-place kernels)
+        self._pixels, self._scratch[name] = self._scratch[name], self._pixels
+
+    def image(self):
+        if self._image is None:
+            self._image = Image.fromarray(self._pixels, mode='RGB')
+        return self._image
+
+    def set_image(self, image):
+        self._image = image if image.mode == "RGB" else image.convert("RGB")
+        self._stale = True
+
+def _compiled_colour_run(distortions):
+    def step(buffer):
+        buffer.set_image(apply_color_adjustments(buffer.image(), distortions))
+    return step
+
+def _compiled_rain(intensity, seed=None, scale=1.0, variant=0):
+    def step(buffer):
+        width, height = buffer.size
+        _blend_rain_layer(buffer.pixels(), _rain_layer(width, height, intensity, seed, scale, variant))
+    return step
+
+def _compiled_overlay(intensity, overlay_image):
+    def step(buffer):
+        if overlay_image is None:
+            return
+        prepared = _prepared_overlay(overlay_image, buffer.size, intensity)
+        if prepared is None:
+            return
+        pixels = buffer.pixels()
+        _composite_overlay(pixels, prepared, buffer.scratch('overlay', pixels.shape, np.uint16))
+    return step
+
+def _compiled_warp(intensity, warp_params, tiled=False, tile_rows=None):
+    def step(buffer):
+        pixels = buffer.pixels()
+        warped = buffer.scratch('warp', pixels.shape, np.uint8)
+        if tiled:
+            # Strip by strip, without the full-frame float64 coordinate map
+            _warp_strips(pixels, intensity, warp_params, warped, tile_rows)
+        else:
+            width, height = buffer.size
+            coordinates = _cached_warp_coordinates(height, width, intensity, warp_params)
+            for i in range(3):
+                map_coordinates(pixels[:, :, i], coordinates, output=warped[:, :, i], order=1, mode='reflect')
+        buffer.swap_pixels('warp')
+    return step
+
+def _compiled_pil(type, params):
+    def step(buffer):
+        buffer.set_image(apply_distortion(buffer.image(), type, **params))
+    return step
+
+def _compile_step(type, **params):
+    if type == "Rain":
+        return _compiled_rain(params.get("intensity", 0), params.get("seed"), params.get("scale", 1.0), params.get("variant", 0))
+    elif type == "Overlay":
+        return _compiled_overlay(params.get("intensity", 0), params.get("overlay_image", None))
+    elif type == "Warp":
+        if params.get("warp_params") is None:
+            return None
+        return _compiled_warp(params.get("intensity", 0), params["warp_params"], params.get("tiled", False),
+                              params.get("tile_rows"))
+    elif type in ("Blur", "Sharpness"):
+        return _compiled_pil(type, params)
+    return None
+
+def compile_distortions(distortions):
+    steps = []
+    colour_run = []
+    for distortion in distortions:
+        # Consecutive colour steps are folded together by the colour engine
+        if distortion["type"] in COLOR_DISTORTIONS:
+            colour_run.append(distortion)
+            continue
+        if colour_run:
+            steps.append(_compiled_colour_run(colour_run))
+            colour_run = []
+        step = _compile_step(**distortion)
+        if step is not None:
+            steps.append(step)
+    if colour_run:
+        steps.append(_compiled_colour_run(colour_run))
+
+    def run(image):
+        buffer = _WorkingBuffer(image)
+        for step in steps:
+            step(buffer)
+        return buffer.image()
+    return run
+
+# Distorted images, reused across Streamlit reruns while the image and its settings are unchanged
+_PREVIEW_CACHE = _LRUCache(max_bytes=256 * 1024 * 1024)
+
+def get_preview_cache_stats():
+    return _PREVIEW_CACHE.stats()
+
+def clear_preview_cache():
+    _PREVIEW_CACHE.clear()
+
+def image_identity(source):
+    # Cheap identity for an image source: path, mtime and size for files on disk,
+    # the upload id (or name and size) for uploaded file objects
+    if isinstance(source, str):
+        stat = os.stat(source)
+        return (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+    file_id = getattr(source, "file_id", None)
+    if file_id is not None:
+        return ("upload", file_id)
+    return ("upload", getattr(source, "name", None), getattr(source, "size", None))
+
+def distortion_settings_key(distortions):
+    # Normalized, hashable form of a distortion list; overlay images are reduced to a digest
+    def normalize(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, normalize(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(normalize(v) for v in value)
+        if isinstance(value, float):
+            return round(value, 6)
+        if isinstance(value, Image.Image):
+            return ("image", value.mode, value.size, hashlib.sha256(value.tobytes()).hexdigest())
+        if isinstance(value, (bytes, bytearray)):
+            return ("bytes", hashlib.sha256(value).hexdigest())
+        if isinstance(value, io.BytesIO):
+            return ("bytes", hashlib.sha256(value.getvalue()).hexdigest())
+        return value
+    return normalize(distortions)
+
+def cached_distortions(image, distortions, image_key, compiled=False):
+    # apply_distortions, memoized by (image_key, normalized distortions). Only images whose
+    # settings changed are recomputed on a rerun; unseeded Rain keeps its pattern meanwhile.
+    key = (image_key, distortion_settings_key(distortions), compiled)
+    processed = _PREVIEW_CACHE.get(key)
+    if processed is None:
+        processed = apply_distortions(image, distortions, compiled=compiled)
+        size = processed.width * processed.height * len(processed.getbands())
+        _PREVIEW_CACHE.put(key, processed, size)
+    return processed
+
+# Long edge of the downscaled copies used for on-screen previews
+PREVIEW_LONG_EDGE = 640
+
+def proxy_image(source, max_long_edge=PREVIEW_LONG_EDGE):
+    # Decodes a downscaled copy of an image for previews; returns (proxy, scale) where
+    # scale is the proxy size relative to the original
+    if isinstance(source, Image.Image):
+        image = source
+    else:
+        if hasattr(source, "seek"):
+            source.seek(0)
+        image = Image.open(source)
+    original_long_edge = max(image.size)
+    if original_long_edge <= max_long_edge:
+        return image, 1.0
+    scale = max_long_edge / original_long_edge
+    target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    if image is not source:
+        # Lets the JPEG decoder scale down while decoding (only on our own copy, draft changes it in place)
+        image.draft("RGB", target)
+    proxy = image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    return proxy, max(proxy.size) / original_long_edge
+
+def scale_distortions(distortions, scale):
+    # Adjusts resolution-dependent settings so a distortion applied to a copy downscaled
+    # by scale looks like the full-resolution result. Colour steps are scale-free;
+    # Sharpness uses a fixed 3x3 kernel and is left as is.
+    if scale == 1.0:
+        return distortions
+    scaled = []
+    for d in distortions:
+        d = dict(d)
+        if d["type"] == "Blur":
+            d["intensity"] = d.get("intensity", 0) * scale
+        elif d["type"] == "Rain":
+            d["scale"] = d.get("scale", 1.0) * scale
+        elif d["type"] == "Warp" and d.get("warp_params") is not None:
+            warp_params = dict(d["warp_params"])
+            warp_params["wave_amplitude"] = warp_params.get("wave_amplitude", 20) * scale
+            warp_params["wave_frequency"] = warp_params.get("wave_frequency", 0.05) / scale
+            warp_params["bulge_factor"] = warp_params.get("bulge_factor", 30) * scale
+            d["warp_params"] = warp_params
+        scaled.append(d)
+    return scaled
+
+def preview_distortions(proxy, distortions, scale, image_key, compiled=False):
+    # Distorted preview of a proxy made by proxy_image (or a thumbnail), memoized like cached_distortions
+    if scale == 1.0:
+        return cached_distortions(proxy, distortions, image_key, compiled)
+    return cached_distortions(proxy, scale_distortions(distortions, scale), (image_key, "proxy", round(scale, 6)), compiled)
+
+def describe_distortions(distortions):
+    # Human-readable summary of a distortion list, as written to the bulk results
+    distortions_info = []
+    for d in distortions:
+        if d['type'] == 'Color':
+            distortions_info.append(f"{d['type']} (Saturation: {d['saturation']:.2f}, Hue Shift: {d['hue_shift']:.2f})")
+        elif d['type'] == 'Warp':
+            distortions_info.append(f"{d['type']} (Intensity: {d['intensity']:.2f}, Wave Amp: {d['warp_params']['wave_amplitude']:.2f}, Wave Freq: {d['warp_params']['wave_frequency']:.2f}, Bulge: {d['warp_params']['bulge_factor']:.2f})")
+        else:
+            distortions_info.append(f"{d['type']} (Intensity: {d['intensity']:.2f})")
+    return ', '.join(distortions_info)
+
+def run_concurrently(func, items, max_workers=4, processes=False):
+    # Runs func over items on a thread pool (or a process pool, for CPU-bound work on
+    # picklable items) and yields (index, result, error) as each call finishes, so callers
+    # can report progress live and restore input order.
+    # Submission is bounded, and items may be a generator, so a huge item list is neither
+    # queued nor built all at once.
+    # Worker processes are started fresh (forkserver or spawn) rather than forked, so they
+    # never inherit the caller's threads, locks or open connections.
+    items = iter(items)
+    max_workers = max(1, max_workers)
+    if processes:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    with executor:
+        pending = {}
+        next_index = 0
+        exhausted = False
+        while not exhausted or pending:
+            while not exhausted and len(pending) < max_workers * 2:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(func, item)] = next_index
+                next_index += 1
+            if not pending:
+                break
+            future = next(as_completed(pending))
+            index = pending.pop(future)
+            error = future.exception()
+            yield index, (None if error else future.result()), error
+
+PAYLOAD_MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+def encode_image_payload(image, max_long_edge=None, image_format="PNG", quality=85):
+    # Resize (if needed) and encode an image for upload; returns (bytes, mime_type)
+    image_format = image_format.upper()
+    if max_long_edge and max(image.size) > max_long_edge:
+        scale = max_long_edge / max(image.size)
+        target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # The caller's image is never drafted in place; prepare_bulk_image drafts the
+        # images it opens itself
+        image = image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+
+    img_byte_arr = io.BytesIO()
+    if image_format == "PNG":
+        image.save(img_byte_arr, format="PNG")
+    else:
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(img_byte_arr, format=image_format, quality=quality)
+    return img_byte_arr.getvalue(), PAYLOAD_MIME_TYPES[image_format]
+
+def _sniff_mime_type(data):
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+def build_system_instruction(system_instructions, expected_fields, mode="text"):
+    if mode == "packed":
+        json_request = _packed_json_request(expected_fields)
+        return f"{system_instructions}\n\n{json_request}" if system_instructions else json_request
+    if mode == "structured":
+        json_request = _structured_json_request(expected_fields)
+        return f"{system_instructions}\n\n{json_request}" if system_instructions else json_request
+
     # Add the JSON request to the system instructions internally
     json_request = f"""
     After your natural language response, please provide a JSON representation of your analysis.
@@ -155,53 +883,1401 @@ def get_gemini_response(input_text, image, model_name, system_instructions, expe
     Enclose the JSON structure within ===JSON=== tags.
     """
     
-    full_instructions = f"{system_instructions}\n\n{json_request}" if system_instructions else json_request
+    return f"{system_instructions}\n\n{json_request}" if system_instructions else json_request
 
-    # Ensure the image is in the correct format
+def _packed_json_request(expected_fields):
+    return f"""
+    You will receive several images, each introduced by a line of the form "Image <key>:".
+    Analyse every image separately. Start the analysis of each image with a line ===IMAGE <key>===
+    using the key that introduced it.
+    After all analyses, please provide a JSON array with one object per image. Each object must have
+    an "image" field holding the image key, plus the following fields (only include non-empty fields):
+    {', '.join(expected_fields)}
+    Ensure that the content in the JSON matches your natural language responses exactly.
+    Enclose the JSON array within ===JSON=== tags.
+    """
+
+def _structured_json_request(expected_fields):
+    return f"""
+    Reply with a single JSON object. Put your natural language response in the "response" field.
+    Also fill in the following fields where they apply, leaving the others empty:
+    {', '.join(expected_fields)}
+    Ensure that the content of these fields matches your natural language response exactly.
+    """
+
+def build_response_schema(expected_fields):
+    # JSON schema for structured output: the prose answer plus one string per expected field
+    properties = {"response": {"type": "string"}}
+    properties.update({field: {"type": "string"} for field in expected_fields})
+    return {"type": "object", "properties": properties, "required": ["response"]}
+
+# GenerativeModel objects reused across calls, keyed by (model, system instructions, fields)
+_MODEL_POOL = {}
+_MODEL_POOL_LOCK = threading.Lock()
+
+def get_pooled_model(model_name, system_instructions, expected_fields, mode="text"):
+    key = (model_name, system_instructions, tuple(expected_fields), mode)
+    with _MODEL_POOL_LOCK:
+        if key not in _MODEL_POOL:
+            # The fixed instruction block goes through the system_instruction slot once,
+            # instead of being sent as ordinary content with every image
+            instruction = build_system_instruction(system_instructions, expected_fields, mode)
+            model_kwargs = {"system_instruction": instruction}
+            if mode == "structured":
+                model_kwargs["generation_config"] = {
+                    "response_mime_type": "application/json",
+                    "response_schema": build_response_schema(expected_fields),
+                }
+            _MODEL_POOL[key] = (genai.GenerativeModel(model_name, **model_kwargs), instruction)
+        return _MODEL_POOL[key]
+
+def clear_model_pool():
+    with _MODEL_POOL_LOCK:
+        _MODEL_POOL.clear()
+
+@contextlib.contextmanager
+def timed_stage(stats, stage):
+    # Adds the time spent in the block to stats["<stage>_seconds"] (stats may be None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats[f"{stage}_seconds"] = stats.get(f"{stage}_seconds", 0.0) + time.perf_counter() - start
+
+def _record_usage(response, stats):
+    # Token counts, when the backend reports them
+    usage = getattr(response, "usage_metadata", None)
+    for key, attribute in (("prompt_tokens", "prompt_token_count"), ("response_tokens", "candidates_token_count")):
+        value = getattr(usage, attribute, None)
+        if isinstance(value, int):
+            stats[key] = stats.get(key, 0) + value
+
+def _content_bytes(content):
+    return sum(len(part["data"]) if isinstance(part, dict) else len(part.encode("utf-8")) for part in content)
+
+def _image_payload(image, max_long_edge, image_format, quality, stats=None):
+    mime_type = None
+    encode_start = time.perf_counter()
     if image:
         if isinstance(image, Image.Image):
             # Convert PIL Image to bytes
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
+            img_byte_arr, mime_type = encode_image_payload(image, max_long_edge, image_format, quality)
         elif isinstance(image, bytes):
             img_byte_arr = image
+            mime_type = _sniff_mime_type(image)
         else:
             raise ValueError("Unsupported image type. Expected PIL Image or bytes.")
     else:
         img_byte_arr = None
+
+    if stats is not None:
+        stats["payload_bytes"] = len(img_byte_arr) if img_byte_arr else 0
+        stats["encode_seconds"] = time.perf_counter() - encode_start
+        stats["mime_type"] = mime_type
+    return img_byte_arr, mime_type
+
+# Transient failures worth retrying, by category
+_RETRYABLE_ERRORS = (
+    ("rate_limit", (api_exceptions.TooManyRequests,)),
+    ("server_error", (api_exceptions.InternalServerError, api_exceptions.BadGateway, api_exceptions.ServiceUnavailable)),
+    ("timeout", (api_exceptions.DeadlineExceeded, TimeoutError)),
+)
+_RETRYABLE_STATUS_CODES = {429: "rate_limit", 500: "server_error", 502: "server_error", 503: "server_error",
+                           408: "timeout", 504: "timeout"}
+
+def classify_api_error(error):
+    # Returns "rate_limit", "server_error" or "timeout" for transient errors, None otherwise
+    for category, error_types in _RETRYABLE_ERRORS:
+        if isinstance(error, error_types):
+            return category
+    # Other clients' errors by their HTTP status, never by the message text, which may
+    # quote anything (e.g. a prompt or file name containing "500")
+    status = getattr(error, "code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return _RETRYABLE_STATUS_CODES.get(status) if isinstance(status, int) else None
+
+def _retry_after_seconds(error):
+    # Server hints: a Retry-After header, or the retry_delay the Gemini API puts in quota errors
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    for pattern in (r'retry_delay\s*\{\s*seconds:\s*([0-9]+)', r'retry in\s*([0-9]+(?:\.[0-9]+)?)\s*s'):
+        match = re.search(pattern, str(error), re.IGNORECASE)
+        if match:
+            return float(match.group(1))
+    return None
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive transient failures and makes callers wait
+    # reset_seconds before trying the backend again. After the pause exactly one caller is
+    # let through as a trial (half open) while the others wait for its outcome; it closes
+    # the breaker on success and reopens it on failure.
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trips = 0
+        self._trial_owner = None
+        self._lock = threading.Lock()
+        self._trial_done = threading.Condition(self._lock)
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.failures < self.failure_threshold:
+                return "closed"
+            return "open" if time.monotonic() < self.opened_until else "half_open"
+
+    def wait(self, sleep=None):
+        # Blocks while the breaker is open, or half open with another caller's trial in
+        # flight; returns the time spent waiting
+        waited = 0.0
+        served_until = None
+        while True:
+            with self._lock:
+                if self.failures < self.failure_threshold:
+                    return waited
+                remaining = self.opened_until - time.monotonic()
+                # A pause this caller has already slept through counts as over
+                if remaining <= 0 or self.opened_until == served_until:
+                    if self._trial_owner is None:
+                        self._trial_owner = threading.get_ident()
+                        return waited
+                    start = time.monotonic()
+                    if not self._trial_done.wait(self.reset_seconds):
+                        # The trial never reported back (e.g. its thread was interrupted)
+                        self._trial_owner = None
+                    waited += time.monotonic() - start
+                    continue
+                served_until = self.opened_until
+            (sleep or time.sleep)(remaining)
+            waited += remaining
+
+    def release(self):
+        # Ends this thread's trial call without an outcome, e.g. on a non-transient error
+        with self._lock:
+            if self._trial_owner == threading.get_ident():
+                self._trial_owner = None
+                self._trial_done.notify_all()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_owner = None
+            self._trial_done.notify_all()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_until = time.monotonic() + self.reset_seconds
+                self.trips += 1
+            self._trial_owner = None
+            self._trial_done.notify_all()
+
+def call_with_retries(func, max_retries=3, base_delay=1.0, max_delay=30.0, breaker=None, stats=None, sleep=None):
+    # Calls func(), retrying transient errors with jittered exponential backoff.
+    # Non-transient errors and the last failed attempt are raised to the caller.
+    sleep = sleep or time.sleep
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.wait(sleep)
+        try:
+            result = func()
+        except Exception as e:
+            category = classify_api_error(e)
+            if category is None:
+                if breaker is not None:
+                    breaker.release()
+                raise
+            if breaker is not None:
+                breaker.record_failure()
+            if stats is not None:
+                stats["last_error_type"] = category
+            if attempt >= max_retries:
+                raise
+            # Full jitter capped at max_delay, but never sooner than the server asked for
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            retry_after = _retry_after_seconds(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            attempt += 1
+            if stats is not None:
+                stats["retries"] = stats.get("retries", 0) + 1
+            print(f"Retrying after {category} error ({attempt}/{max_retries}) in {delay:.1f}s: {str(e)}")
+            sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+def get_gemini_response(input_text, image, model_name, system_instructions, expected_fields, cache=None, refresh_cache=False,
+                        max_long_edge=None, image_format="PNG", quality=85, stats=None, structured_output=False,
+                        max_retries=3, breaker=None):
+    # Ensure the image is in the correct format
+    img_byte_arr, mime_type = _image_payload(image, max_long_edge, image_format, quality, stats)
+    if stats is None:
+        stats = {}
+    stats.setdefault("retries", 0)
+    retry_options = {"max_retries": max_retries, "breaker": breaker, "stats": stats}
     
     try:
         content = []
-        if full_instructions:
-            content.append(full_instructions)
         if input_text:
             content.append(input_text)
         if img_byte_arr:
-            content.append({"mime_type": "image/png", "data": img_byte_arr})
+            content.append({"mime_type": mime_type, "data": img_byte_arr})
         
         if content:
-            response = model.generate_content(content)
-            text_response = response.text if response else "No response from the model."
-            
-            # Extract JSON from the response
-            json_match = re.search(r'===JSON===\s*(.*?)\s*===JSON===', text_response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
+            request = (content, img_byte_arr, input_text, model_name, system_instructions, expected_fields, cache, refresh_cache, retry_options)
+            if structured_output:
                 try:
-                    json_response = json.loads(json_str)
-                    # Remove empty fields from the JSON response
-                    json_response = {k: v for k, v in json_response.items() if v}
-                    # Remove the JSON part from the text response
-                    text_response = re.sub(r'===JSON===.*===JSON===', '', text_response, flags=re.DOTALL).strip()
-                except json.JSONDecodeError:
-                    json_response = {"error": "Failed to parse JSON from AI response"}
-            else:
-                json_response = {"error": "No JSON found in AI response"}
-            
-            return text_response, json_response  # Return JSON as a Python dictionary
+                    result = _generate_response(*request, mode="structured")
+                    stats["status"] = "ok"
+                    return result
+                except Exception as e:
+                    # Keep the free-text request as a fallback, unless the backend itself is failing
+                    if classify_api_error(e) is not None:
+                        raise
+                    print(f"Structured output failed, falling back to free text: {str(e)}")
+            result = _generate_response(*request, mode="text")
+            stats["status"] = "ok"
+            return result
         else:
             return "No input provided to the model.", {}
     except Exception as e:
+        stats["status"] = "failed"
         error_message = f"Error generating response: {str(e)}"
         return error_message, {"error": error_message}
+
+def _generate_response(content, img_byte_arr, input_text, model_name, system_instructions, expected_fields, cache, refresh_cache, retry_options, mode):
+    model, full_instructions = get_pooled_model(model_name, system_instructions, expected_fields, mode)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = response_cache_key(img_byte_arr, input_text, full_instructions, model_name, expected_fields)
+        cached = None if refresh_cache else cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    stats = retry_options["stats"]
+    stats["request_bytes"] = _content_bytes(content)
+
+    def request():
+        with timed_stage(stats, "request"):
+            return model.generate_content(content)
+
+    response = call_with_retries(request, **retry_options)
+    _record_usage(response, stats)
+    with timed_stage(stats, "parse"):
+        if mode == "structured":
+            stats["response_bytes"] = len(response.text.encode("utf-8"))
+            text_response, json_response = _parse_structured_response(response.text)
+        else:
+            response_text = response.text if response else "No response from the model."
+            stats["response_bytes"] = len(response_text.encode("utf-8"))
+            text_response, json_response = _parse_marked_response(response_text)
+
+    # Only keep well-formed answers so failed parses are retried next time
+    if cache_key is not None and "error" not in json_response:
+        cache.put(cache_key, text_response, json_response)
+
+    return text_response, json_response  # Return JSON as a Python dictionary
+
+def _parse_structured_response(text_response):
+    json_response = json.loads(text_response)
+    if not isinstance(json_response, dict):
+        raise ValueError("Structured response is not a JSON object")
+    text_response = str(json_response.pop("response", "")).strip()
+    # Remove empty fields from the JSON response
+    return text_response, {k: v for k, v in json_response.items() if v}
+
+def _parse_marked_response(text_response):
+    # Extract JSON from the response
+    json_match = re.search(r'===JSON===\s*(.*?)\s*===JSON===', text_response, re.DOTALL)
+    if json_match:
+        json_str = json_match.group(1)
+        try:
+            json_response = json.loads(json_str)
+            # Remove empty fields from the JSON response
+            json_response = {k: v for k, v in json_response.items() if v}
+            # Remove the JSON part from the text response
+            text_response = re.sub(r'===JSON===.*===JSON===', '', text_response, flags=re.DOTALL).strip()
+        except json.JSONDecodeError:
+            json_response = {"error": "Failed to parse JSON from AI response"}
+    else:
+        json_response = {"error": "No JSON found in AI response"}
+    return text_response, json_response
+
+def get_gemini_packed_response(input_text, images, model_name, system_instructions, expected_fields,
+                               max_long_edge=None, image_format="PNG", quality=85, stats=None, **single_kwargs):
+    # Sends several images that share one prompt in a single request and splits the answer
+    # back into one (text_response, json_response) per image. Images whose part of the
+    # answer cannot be recovered are sent again on their own with get_gemini_response.
+    # With a response cache, images already answered are not packed, and every split answer
+    # is stored under the key get_gemini_response would use for that image.
+    if stats is None:
+        stats = [{} for _ in images]
+    payload_options = {"max_long_edge": max_long_edge, "image_format": image_format, "quality": quality}
+    responses = [None] * len(images)
+    payloads = [_image_payload(image, stats=image_stats, **payload_options) for image, image_stats in zip(images, stats)]
+
+    cache = single_kwargs.get("cache")
+    cache_keys = [None] * len(images)
+    if cache is not None:
+        mode = "structured" if single_kwargs.get("structured_output") else "text"
+        instructions = build_system_instruction(system_instructions, expected_fields, mode)
+        for i, (img_byte_arr, _) in enumerate(payloads):
+            cache_keys[i] = response_cache_key(img_byte_arr, input_text, instructions, model_name, expected_fields)
+            cached = None if single_kwargs.get("refresh_cache") else cache.get(cache_keys[i])
+            if cached is not None:
+                responses[i] = cached
+                stats[i].update(packed=False, retries=0, status="ok")
+
+    misses = [i for i in range(len(images)) if responses[i] is None]
+    if len(misses) > 1:
+        model, _ = get_pooled_model(model_name, system_instructions, expected_fields, mode="packed")
+        content = [input_text] if input_text else []
+        for key, i in enumerate(misses, start=1):
+            img_byte_arr, mime_type = payloads[i]
+            content.append(f"Image {key}:")
+            content.append({"mime_type": mime_type, "data": img_byte_arr})
+        packed_stats = {"retries": 0}
+
+        def request():
+            with timed_stage(packed_stats, "request"):
+                return model.generate_content(content)
+
+        try:
+            response = call_with_retries(request, stats=packed_stats,
+                                         max_retries=single_kwargs.get("max_retries", 3),
+                                         breaker=single_kwargs.get("breaker"))
+            _record_usage(response, packed_stats)
+            with timed_stage(packed_stats, "parse"):
+                response_text = response.text if response else ""
+                split = _split_packed_response(response_text)
+            # Every image waited for the whole request; sizes and tokens are shared out between them
+            shared = {"request_seconds": packed_stats["request_seconds"], "parse_seconds": packed_stats["parse_seconds"],
+                      "request_bytes": _content_bytes(content) // len(misses),
+                      "response_bytes": len(response_text.encode("utf-8")) // len(misses)}
+            for key in ("prompt_tokens", "response_tokens"):
+                if key in packed_stats:
+                    shared[key] = packed_stats[key] // len(misses)
+            for key, parsed in split.items():
+                if 1 <= key <= len(misses):
+                    i = misses[key - 1]
+                    responses[i] = parsed
+                    stats[i].update(shared, packed=True, retries=packed_stats["retries"], status="ok")
+                    # Only keep well-formed answers so failed parses are retried next time
+                    if cache_keys[i] is not None and "error" not in parsed[1]:
+                        cache.put(cache_keys[i], *parsed)
+        except Exception as e:
+            print(f"Packed request failed, falling back to single requests: {str(e)}")
+
+    for i, image in enumerate(images):
+        if responses[i] is None:
+            stats[i]["packed"] = False
+            responses[i] = get_gemini_response(input_text, image, model_name, system_instructions, expected_fields,
+                                               stats=stats[i], **payload_options, **single_kwargs)
+    return responses
+
+def _split_packed_response(text_response):
+    # Returns {image key: (text_response, json_response)} for every image that could be parsed
+    json_match = re.search(r'===JSON===\s*(.*?)\s*===JSON===', text_response, re.DOTALL)
+    if not json_match:
+        return {}
+    try:
+        items = json.loads(json_match.group(1))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    sections = {}
+    for match in re.finditer(r'===IMAGE\s+(\d+)===\s*(.*?)(?====IMAGE|===JSON===|$)', text_response, re.DOTALL):
+        sections[int(match.group(1))] = match.group(2).strip()
+
+    parsed = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            key = int(item.get("image"))
+        except (TypeError, ValueError):
+            continue
+        if key not in sections:
+            continue
+        # Remove empty fields from the JSON response
+        parsed[key] = (sections[key], {k: v for k, v in item.items() if v and k != "image"})
+    return parsed
+
+def response_cache_key(image_bytes, input_text, instructions, model_name, expected_fields):
+    digest = hashlib.sha256()
+    for part in (image_bytes or b"", input_text or "", instructions or "", model_name, json.dumps(list(expected_fields))):
+        part = part if isinstance(part, bytes) else part.encode("utf-8")
+        # Length-prefix every part so different splits can never collide
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+class ResponseCache:
+    # On-disk (SQLite) cache of model answers, keyed by response_cache_key().
+    # Entries older than ttl_seconds are ignored, and the least recently used
+    # entries are evicted once the stored responses exceed max_bytes.
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, ttl_seconds=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, text_response TEXT, json_response TEXT, "
+                "size INTEGER, created_at REAL, accessed_at REAL)"
+            )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT text_response, json_response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl_seconds is not None and now - row[2] > self.ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0], json.loads(row[1])
+
+    def put(self, key, text_response, json_response):
+        json_text = json.dumps(json_response)
+        size = len(text_response.encode("utf-8")) + len(json_text.encode("utf-8"))
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, text_response, json_text, size, now, now)
+            )
+            self._evict()
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self._lock:
+            count, total = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": count, "bytes": total, "max_bytes": self.max_bytes}
+
+    def _evict(self):
+        if self.ttl_seconds is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until the cache fits again
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+# Bulk analysis, shared by the Streamlit app and the headless batch runner (src/batch.py)
+EXPECTED_JSON_FIELDS = [
+    "scene_description",
+    "safety_features",
+    "potential_hazards",
+    "traffic_signs_effectiveness",
+    "road_conditions",
+    "suggested_improvements",
+    "intersection_design",
+    "road_markings_issues",
+    "cyclist_safety",
+    "lighting_conditions",
+    "traffic_lights_visibility",
+    "blind_spots",
+    "overall_safety"
+]
+
+DEFAULT_SYSTEM_INSTRUCTIONS = """
+    You are an AI assistant specialized in analyzing road safety images. Your task is to:
+    1. Describe the scene(s) objectively, noting visible road features, signage, and potential hazards.
+    2. Identify potential safety issues or concerns based on what you can see in the image(s).
+    3. Suggest improvements or preventive measures for any identified issues.
+    4. Comment on the overall safety of the scene(s) depicted.
+    5. If multiple images are provided, note any significant differences or patterns, but do not assume they are necessarily sequential or related unless explicitly stated.
+    6. Analyze each image individually, whether it's a single frame or part of a set.
+    7. If any distortions or unusual visual effects are present, mention them only if they are clearly visible and relevant to safety analysis.
+    Please provide your analysis in a clear, concise manner, focusing on road safety aspects. Adapt your response to the number and nature of the images provided.
+    """
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+def iter_images(folder, recursive=False, include=None, exclude=None, extensions=IMAGE_EXTENSIONS):
+    # Streams image paths under folder with os.scandir, in a stable (sorted) order.
+    # include/exclude are glob patterns; a pattern with a "/" is matched against the path
+    # relative to folder, otherwise against the file name. Symlinked folders are not followed.
+    include = [p for p in (include or []) if p]
+    exclude = [p for p in (exclude or []) if p]
+
+    def matches(patterns, relative_path, name):
+        return any(fnmatch.fnmatch(relative_path if "/" in p else name, p) for p in patterns)
+
+    pending = [folder]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as scan:
+                entries = sorted(scan, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Could not read {directory}: {str(e)}")
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    subdirectories.append(entry.path)
+                continue
+            if not entry.name.lower().endswith(extensions):
+                continue
+            relative_path = os.path.relpath(entry.path, folder).replace(os.sep, "/")
+            if include and not matches(include, relative_path, entry.name):
+                continue
+            if exclude and matches(exclude, relative_path, entry.name):
+                continue
+            yield entry.path
+        # Files of a folder come before its subfolders, which are visited in name order
+        pending.extend(reversed(subdirectories))
+
+def discover_images(folder, recursive=False, include=None, exclude=None, every_nth=1, sample=None, limit=None, seed=None):
+    # Image paths under folder after filtering, then keeping every_nth image, then a random
+    # sample of that many (kept in folder order), then at most limit of them
+    paths = itertools.islice(iter_images(folder, recursive, include, exclude), 0, None, max(1, every_nth))
+    if sample:
+        # Reservoir sampling keeps memory bounded by the sample size on huge trees
+        rng = random.Random(seed)
+        reservoir = []
+        for n, path in enumerate(paths):
+            if n < sample:
+                reservoir.append((n, path))
+            else:
+                j = rng.randint(0, n)
+                if j < sample:
+                    reservoir[j] = (n, path)
+        paths = (path for _, path in sorted(reservoir))
+    return list(itertools.islice(paths, limit))
+
+# Per-row timing of each stage of a request, as written to the results
+STAGE_COLUMNS = {
+    "Decode": "Decode Time (s)",
+    "Distort": "Distort Time (s)",
+    "Encode": "Encode Time (s)",
+    "Request": "Request Time (s)",
+    "Parse": "Parse Time (s)",
+}
+
+RESULT_COLUMNS = ["Image", "Distortions", "Input Text", "AI Response", "JSON Response", "Payload Bytes",
+                  *STAGE_COLUMNS.values(), "Request Bytes", "Response Bytes", "Prompt Tokens", "Response Tokens",
+                  "Retries", "Status"]
+
+def prepare_bulk_image(job, compiled=False, stats=None, max_long_edge=None):
+    distortions_list = job["distortions"]
+    # Only apply distortions if there are valid distortions to apply
+    distort = any(d for d in distortions_list if d.get("overlay_image") is not None or d["type"] != "Overlay")
+    with timed_stage(stats, "decode"):
+        image = Image.open(io.BytesIO(job["file"]) if isinstance(job["file"], bytes) else job["file"])
+        if not distort and max_long_edge and max(image.size) > max_long_edge:
+            # Undistorted images are only needed at upload size, so the JPEG decoder may
+            # scale down while decoding (distortions still see the full image)
+            scale = max_long_edge / max(image.size)
+            image.draft("RGB", (max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+        image.load()
+
+    if distort:
+        with timed_stage(stats, "distort"):
+            return apply_distortions(image, distortions_list, compiled=compiled)
+    return image
+
+def bulk_result(job, text_response, json_response, stats, expected_fields=EXPECTED_JSON_FIELDS):
+    # Create a result dictionary with basic info
+    row = {
+        "Image": job["file_name"],
+        "Distortions": describe_distortions(job["distortions"]),
+        "Input Text": job["input_text"],
+        "AI Response": text_response,
+        "JSON Response": json.dumps(json_response, indent=2),
+        "Payload Bytes": stats.get("payload_bytes", 0),
+        **{column: round(stats.get(f"{stage.lower()}_seconds", 0.0), 6) for stage, column in STAGE_COLUMNS.items()},
+        "Request Bytes": stats.get("request_bytes", 0),
+        "Response Bytes": stats.get("response_bytes", 0),
+        "Prompt Tokens": stats.get("prompt_tokens"),
+        "Response Tokens": stats.get("response_tokens"),
+        "Retries": stats.get("retries", 0),
+        "Status": stats.get("status", "")
+    }
+    # JSON fields become their own columns straight from the parsed response
+    for field in expected_fields:
+        value = json_response.get(field, '')
+        row[field] = ', '.join(map(str, value)) if isinstance(value, list) else value
+    return row
+
+def stage_percentiles(rows, percentiles=(50, 95)):
+    # Percentiles of each stage's time (in seconds) over result rows or a results DataFrame,
+    # one row per stage that was timed at least once
+    results_df = pd.DataFrame(rows)
+    table = {}
+    for stage, column in STAGE_COLUMNS.items():
+        if column not in results_df:
+            continue
+        values = pd.to_numeric(results_df[column], errors="coerce").dropna()
+        if len(values) and values.any():
+            table[stage] = {f"p{p}": float(np.percentile(values, p)) for p in percentiles}
+    return pd.DataFrame.from_dict(table, orient="index", columns=[f"p{p}" for p in percentiles])
+
+def plan_bulk_units(jobs, images_per_request=1, start_index=0):
+    # Work units: single images, or runs of consecutive images sharing a prompt when packing
+    units = []
+    for i in range(start_index, len(jobs)):
+        job = jobs[i]
+        if (images_per_request > 1 and units and len(units[-1]) < images_per_request
+                and jobs[units[-1][0]]["input_text"] == job["input_text"]):
+            units[-1].append(i)
+        else:
+            units.append([i])
+    return units
+
+PAYLOAD_OPTIONS = ("max_long_edge", "image_format", "quality")
+
+def prepare_unit_payloads(task):
+    # Decode, distort and encode every image of a work unit. Takes a single picklable
+    # (jobs, compiled, payload_options) tuple so it can run in a worker process.
+    jobs, compiled, payload_options = task
+    payloads = []
+    for job in jobs:
+        start = time.perf_counter()
+        stats = {}
+        image = prepare_bulk_image(job, compiled, stats, payload_options.get("max_long_edge"))
+        payload, _ = _image_payload(image, payload_options.get("max_long_edge"),
+                                    payload_options.get("image_format", "PNG"), payload_options.get("quality", 85), stats)
+        stats["prepare_seconds"] = time.perf_counter() - start
+        payloads.append((payload, stats))
+    return payloads
+
+def analyse_prepared_unit(jobs, payloads, model_name, system_instructions, expected_fields, **request_options):
+    # Sends the payloads made by prepare_unit_payloads, returning one result row per job
+    images = [payload for payload, _ in payloads]
+    stats = [{} for _ in jobs]
+
+    # Get AI response
+    if len(jobs) == 1:
+        responses = [get_gemini_response(jobs[0]["input_text"], images[0], model_name, system_instructions,
+                                         expected_fields, stats=stats[0], **request_options)]
+    else:
+        responses = get_gemini_packed_response(jobs[0]["input_text"], images, model_name, system_instructions,
+                                               expected_fields, stats=stats, **request_options)
+    rows = []
+    for job, (text, json_response), job_stats, (_, prepared_stats) in zip(jobs, responses, stats, payloads):
+        # Size and encode time come from the preparation stage, not from re-reading the bytes
+        job_stats.update(prepared_stats)
+        rows.append(bulk_result(job, text, json_response, job_stats, expected_fields))
+    return rows
+
+def analyse_bulk_unit(jobs, model_name, system_instructions, expected_fields, compiled=False, **request_options):
+    # Distorts and analyses one work unit on the calling thread, returning one result row per job
+    payload_options = {k: request_options[k] for k in PAYLOAD_OPTIONS if k in request_options}
+    payloads = prepare_unit_payloads((jobs, compiled, payload_options))
+    return analyse_prepared_unit(jobs, payloads, model_name, system_instructions, expected_fields, **request_options)
+
+def run_bulk_analysis(jobs, model_name, system_instructions, expected_fields=EXPECTED_JSON_FIELDS, max_workers=4,
+                      images_per_request=1, compiled=False, start_index=0, cpu_workers=0, **request_options):
+    # Yields (job indices, result rows, error) for each work unit as it finishes.
+    # Jobs before start_index are skipped, e.g. when resuming from a RunManifest.
+    # request_options are passed on to get_gemini_response (cache, retries, payload options...).
+    # With cpu_workers > 0, images are prepared in that many processes while max_workers
+    # threads wait on the API, see _run_bulk_pipeline.
+    units = plan_bulk_units(jobs, images_per_request, start_index)
+    if cpu_workers > 0:
+        yield from _run_bulk_pipeline(jobs, units, model_name, system_instructions, expected_fields, max_workers,
+                                      compiled, cpu_workers, request_options)
+        return
+
+    def analyse(unit):
+        return analyse_bulk_unit([jobs[i] for i in unit], model_name, system_instructions, expected_fields,
+                                 compiled, **request_options)
+
+    for u, rows, error in run_concurrently(analyse, units, max_workers=max_workers):
+        yield units[u], rows, error
+
+def _picklable_job(job):
+    # Uploaded file objects are sent to worker processes as plain bytes
+    file = job["file"]
+    if not isinstance(file, (str, bytes)):
+        file = file.getvalue() if hasattr(file, "getvalue") else file.read()
+    return {**job, "file": file}
+
+def _run_bulk_pipeline(jobs, units, model_name, system_instructions, expected_fields, max_workers, compiled,
+                       cpu_workers, request_options, queue_size=None):
+    # Two-stage pipeline: a process pool decodes, distorts and encodes work units while
+    # inference threads send the finished payloads. The bounded queue between the stages
+    # gives backpressure, so preparation never runs more than queue_size units ahead.
+    payload_options = {k: request_options[k] for k in PAYLOAD_OPTIONS if k in request_options}
+    max_workers = max(1, max_workers)
+    ready = queue.Queue(maxsize=queue_size or max_workers * 2)
+    finished = queue.Queue()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        produced = set()
+        try:
+            # Built as the pool asks for them, so only the units in flight hold file bytes
+            tasks = (([_picklable_job(jobs[i]) for i in unit], compiled, payload_options) for unit in units)
+            for u, payloads, error in run_concurrently(prepare_unit_payloads, tasks, max_workers=cpu_workers, processes=True):
+                produced.add(u)
+                if not put((u, payloads, error)):
+                    return
+        except Exception as e:
+            # e.g. a broken process pool: report every unit that was not prepared
+            for u in range(len(units)):
+                if u not in produced and not put((u, None, e)):
+                    return
+        finally:
+            for _ in range(max_workers):
+                put(None)
+
+    def consume():
+        try:
+            while not stop.is_set():
+                try:
+                    item = ready.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    return
+                u, payloads, error = item
+                rows = None
+                if error is None:
+                    try:
+                        rows = analyse_prepared_unit([jobs[i] for i in units[u]], payloads, model_name,
+                                                     system_instructions, expected_fields, **request_options)
+                    except Exception as e:
+                        error = e
+                finished.put((u, rows, error))
+        finally:
+            finished.put(None)
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=consume, daemon=True) for _ in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads) - 1
+        while running:
+            item = finished.get()
+            if item is None:
+                running -= 1
+                continue
+            u, rows, error = item
+            yield units[u], rows, error
+    finally:
+        stop.set()
+
+# Distortion sweeps: every image at every combination of a grid of distortion settings
+
+def expand_distortion_grid(grid):
+    # Every chain of a sweep grid. The grid is a distortion list in which any setting (or
+    # warp_params entry) may be a list of values to sweep. Returns [(chain, setting)] in grid
+    # order, where setting maps a column name such as "Blur intensity" to the swept value;
+    # consecutive chains differ in their last steps first, so shared prefixes stay together.
+    step_variants = []
+    column_counts = {}
+    for step in grid:
+        swept = []
+        for name, value in step.items():
+            if isinstance(value, dict):
+                swept += [((name, sub), sub, values) for sub, values in value.items() if isinstance(values, list)]
+            elif isinstance(value, list):
+                swept.append(((name,), name, value))
+        # A type that appears twice in the grid gets numbered columns for its second step
+        column_counts[step["type"]] = column_counts.get(step["type"], 0) + 1
+        suffix = f" {column_counts[step['type']]}" if column_counts[step["type"]] > 1 else ""
+
+        variants = []
+        for values in itertools.product(*(values for _, _, values in swept)):
+            variant = {k: dict(v) if isinstance(v, dict) else v for k, v in step.items()}
+            setting = {}
+            for (path, name, _), value in zip(swept, values):
+                if len(path) == 1:
+                    variant[path[0]] = value
+                else:
+                    variant[path[0]][path[1]] = value
+                setting[f"{step['type']}{suffix} {name}"] = value
+            variants.append((variant, setting))
+        step_variants.append(variants)
+
+    chains = []
+    for combination in itertools.product(*step_variants):
+        setting = {}
+        for _, step_setting in combination:
+            setting.update(step_setting)
+        chains.append(([variant for variant, _ in combination], setting))
+    return chains
+
+def sweep_distortions(image, chains, compiled=False):
+    # Applies every chain to image and yields (chain index, distorted image). The chains are
+    # evaluated as a prefix tree, so a leading step shared by several chains is computed once,
+    # and only the images along the branch being walked are kept in memory.
+    root = ({}, [])
+    for index, chain in enumerate(chains):
+        node = root
+        for step in chain:
+            key = distortion_settings_key([step])
+            if key not in node[0]:
+                node[0][key] = (step, {}, [])
+            node = node[0][key][1:]
+        node[1].append(index)
+
+    def visit(image, children):
+        for step, grandchildren, leaves in children.values():
+            distorted = apply_distortions(image, [step], compiled)
+            for index in leaves:
+                yield index, distorted
+            yield from visit(distorted, grandchildren)
+
+    for index in root[1]:
+        yield index, image
+    yield from visit(image, root[0])
+
+def analyse_sweep_image(job, chains, model_name, system_instructions, expected_fields=EXPECTED_JSON_FIELDS,
+                        compiled=False, max_workers=4, first_setting=0, **request_options):
+    # Analyses one image at every chain of expand_distortion_grid and yields (chain indices,
+    # rows, error) as requests finish, so one failed request only fails its own rows.
+    # Settings that produce byte-identical images share a single request; their rows name
+    # the setting whose answer they reuse in "Identical To".
+    # Payloads are encoded as the prefix walk reaches them and handed to the request threads
+    # as they free up, so only the requests in flight hold one.
+    # Rows before first_setting (already written by an interrupted run) are not yielded.
+    image = Image.open(io.BytesIO(job["file"]) if isinstance(job["file"], bytes) else job["file"])
+    payload_options = {k: request_options[k] for k in PAYLOAD_OPTIONS if k in request_options}
+    same_as = {}  # Chain index -> the index whose identical image was requested
+    digests = {}
+    held = {}  # Payloads of representatives that were already written, in case a later row needs them
+    requested = []
+    duplicates = {}  # Representative -> rows waiting for its answer
+
+    def payloads():
+        for index, distorted in sweep_distortions(image, [chain for chain, _ in chains], compiled):
+            digest = hashlib.sha256(distorted.tobytes())
+            digest.update(repr((distorted.mode, distorted.size)).encode("utf-8"))
+            digest = digest.digest()
+            if digest in digests:
+                representative = digests[digest]
+                same_as[index] = representative
+                if index >= first_setting:
+                    duplicates.setdefault(representative, []).append(index)
+                    if representative in held:
+                        # Representatives are only requested when one of their rows is still to be written
+                        requested.append(representative)
+                        yield held.pop(representative)
+                continue
+            digests[digest] = index
+            start = time.perf_counter()
+            stats = {}
+            payload, _ = _image_payload(distorted, payload_options.get("max_long_edge"),
+                                        payload_options.get("image_format", "PNG"), payload_options.get("quality", 85), stats)
+            stats["prepare_seconds"] = time.perf_counter() - start
+            if index >= first_setting:
+                requested.append(index)
+                yield index, payload, stats
+            else:
+                held[index] = (index, payload, stats)
+
+    def analyse(item):
+        index, payload, prepared_stats = item
+        stats = {}
+        text, json_response = get_gemini_response(job["input_text"], payload, model_name, system_instructions,
+                                                  expected_fields, stats=stats, **request_options)
+        stats.update(prepared_stats)
+        return bulk_result({**job, "distortions": chains[index][0]}, text, json_response, stats, expected_fields)
+
+    def duplicate_row(index, response):
+        # Nothing was prepared or sent for this row
+        return {**response, "Distortions": describe_distortions(chains[index][0]), "Identical To": response["Distortions"],
+                "Payload Bytes": 0, **{column: 0.0 for column in STAGE_COLUMNS.values()}, "Request Bytes": 0,
+                "Response Bytes": 0, "Prompt Tokens": None, "Response Tokens": None, "Retries": 0}
+
+    answered = {}  # Representative -> (row, error)
+
+    def answer_rows(representative, indices):
+        response, error = answered[representative]
+        if error is not None:
+            return indices, None, error
+        rows = [dict(response) if index == representative else duplicate_row(index, response) for index in indices]
+        for index, row in zip(indices, rows):
+            row.update(chains[index][1])
+        return indices, rows, None
+
+    def late_duplicates():
+        # Identical images the walk found after their representative's answer came back
+        for representative in [r for r in duplicates if r in answered]:
+            yield answer_rows(representative, duplicates.pop(representative))
+
+    for p, row, error in run_concurrently(analyse, payloads(), max_workers=max_workers):
+        representative = requested[p]
+        answered[representative] = (row, error)
+        indices = ([representative] if representative >= first_setting else []) + duplicates.pop(representative, [])
+        yield answer_rows(representative, indices)
+        yield from late_duplicates()
+    yield from late_duplicates()
+
+def sweep_columns(chains):
+    # Result columns for the swept settings, in grid order, followed by "Identical To"
+    columns = []
+    for _, setting in chains:
+        columns += [column for column in setting if column not in columns]
+    return columns + ["Identical To"]
+
+def run_sweep_analysis(jobs, chains, model_name, system_instructions, expected_fields=EXPECTED_JSON_FIELDS,
+                       max_workers=4, compiled=False, start_index=0, **request_options):
+    # Yields (row indices, rows, error) for each image, like run_bulk_analysis. Row
+    # job_index * len(chains) + chain_index is the image at that chain, and rows before
+    # start_index are skipped, e.g. when resuming from a RunManifest.
+    # Images are distorted one at a time; the requests for each run on max_workers threads.
+    for j in range(start_index // len(chains), len(jobs)):
+        first_setting = max(0, start_index - j * len(chains))
+        remaining = set(range(first_setting, len(chains)))
+        try:
+            for settings, rows, error in analyse_sweep_image(jobs[j], chains, model_name, system_instructions,
+                                                             expected_fields, compiled, max_workers, first_setting,
+                                                             **request_options):
+                remaining.difference_update(settings)
+                yield [j * len(chains) + i for i in settings], rows, error
+        except Exception as e:
+            # e.g. the image could not be read: every row not yet reported fails with it
+            if remaining:
+                yield [j * len(chains) + i for i in sorted(remaining)], None, e
+
+def read_results(path, expected_fields=EXPECTED_JSON_FIELDS):
+    # Loads a file written by ResultWriter back into the results table
+    file_format = result_file_format(path)
+    if file_format == "jsonl":
+        results_df = pd.read_json(path, lines=True, dtype=False)
+    elif file_format == "parquet":
+        results_df = pd.read_parquet(path)
+    else:
+        results_df = pd.read_csv(path, keep_default_na=False)
+    return tidy_results(results_df, expected_fields)
+
+def tidy_results(results_df, expected_fields=EXPECTED_JSON_FIELDS):
+    # Remove empty columns
+    results_df = results_df.dropna(axis=1, how='all')
+
+    # Remove columns that are entirely empty strings
+    results_df = results_df.loc[:, (results_df != '').any()]
+
+    # Reorder columns, only including columns that exist in the DataFrame; other columns
+    # (such as sweep settings) go between the standard columns and the JSON fields
+    extra_columns = [col for col in results_df.columns if col not in RESULT_COLUMNS and col not in expected_fields]
+    columns_order = RESULT_COLUMNS + extra_columns + [col for col in expected_fields if col in results_df.columns]
+    columns_order = [col for col in columns_order if col in results_df.columns]
+    return results_df[columns_order]
+
+RESULT_FILE_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".parquet": "parquet"}
+
+def result_file_format(path):
+    return RESULT_FILE_FORMATS.get(os.path.splitext(path)[1].lower(), "csv")
+
+class ResultWriter:
+    # Appends bulk result rows to a CSV, JSONL or Parquet file as soon as they complete,
+    # so a crashed run keeps everything finished so far. Rows finish out of order; each
+    # one is held back until every earlier row has been written (or skipped).
+    # With a RunManifest, every row that reaches the disk is recorded in it, and a
+    # resumed run continues the file from the last recorded row.
+    # Parquet files cannot be appended to, so each row group is written as a complete part
+    # file in <path>.parts and only recorded once it is there; close() joins the parts into path.
+    # extra_columns (e.g. sweep_columns) are written after the standard columns.
+    def __init__(self, path, expected_fields=EXPECTED_JSON_FIELDS, file_format=None, row_group_size=100, manifest=None,
+                 extra_columns=()):
+        self.path = path
+        self.columns = RESULT_COLUMNS + list(extra_columns) + list(expected_fields)
+        self.file_format = file_format or result_file_format(path)
+        self.row_group_size = row_group_size
+        self.manifest = manifest
+        resume = manifest is not None and manifest.next_index > 0
+        self._parts_dir = path + ".parts"
+        if resume and not os.path.exists(path) and not os.path.isdir(self._parts_dir):
+            # The results file is gone, so nothing recorded in the manifest can be reused
+            manifest.reset()
+            resume = False
+        self.rows_written = manifest.rows_written if resume else 0
+        self._next_index = manifest.next_index if resume else 0
+        self._pending = {}
+        self._row_group = []
+        self._unrecorded = []
+        self._parts = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.file_format == "parquet":
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("Writing Parquet results requires pyarrow (pip install pyarrow)")
+            self._pa = pyarrow
+            self._pq = pyarrow.parquet
+            numeric = {column: pyarrow.int64() for column in ("Payload Bytes", "Request Bytes", "Response Bytes",
+                                                              "Prompt Tokens", "Response Tokens", "Retries")}
+            numeric.update({column: pyarrow.float64() for column in STAGE_COLUMNS.values()})
+            self._schema = pyarrow.schema([(c, numeric.get(c, pyarrow.string())) for c in self.columns])
+            self._file = None
+            if resume and not self._resume_parts():
+                manifest.reset()
+                resume = False
+                self.rows_written = self._next_index = 0
+            if not resume:
+                shutil.rmtree(self._parts_dir, ignore_errors=True)
+                os.makedirs(self._parts_dir)
+        elif resume:
+            # Drop anything written after the last recorded row
+            self._file = open(path, "r+", newline="", encoding="utf-8")
+            self._file.seek(manifest.results_bytes)
+            self._file.truncate()
+        else:
+            self._file = open(path, "w", newline="", encoding="utf-8")
+        if self.file_format == "csv":
+            self._csv = csv.DictWriter(self._file, fieldnames=self.columns, extrasaction="ignore")
+            if not resume:
+                self._csv.writeheader()
+                self._file.flush()
+
+    def add(self, index, row):
+        # row is None for items that failed without producing a result
+        self._pending[index] = row
+        while self._next_index in self._pending:
+            row = self._pending.pop(self._next_index)
+            # Queued before writing, so the row is recorded with the row group that holds it
+            self._unrecorded.append((self._next_index, (row.get("Status") or "done") if row is not None else "error"))
+            self._next_index += 1
+            if row is not None:
+                self._write(row)
+            if self.file_format != "parquet":
+                self._record()
+
+    def _write(self, row):
+        if self.file_format == "csv":
+            self._csv.writerow(row)
+        elif self.file_format == "jsonl":
+            self._file.write(json.dumps({c: row.get(c, '') for c in self.columns}, default=str) + "\n")
+        else:
+            self._row_group.append(row)
+            if len(self._row_group) >= self.row_group_size:
+                self._write_row_group()
+            return
+        self._file.flush()
+        self.rows_written += 1
+
+    def _resume_parts(self):
+        # Picks up the part files of an interrupted run (or splits a finished file back into
+        # one part). Returns False if they do not hold exactly the rows the manifest recorded.
+        try:
+            if not os.path.isdir(self._parts_dir):
+                os.makedirs(self._parts_dir)
+                os.replace(self.path, self._part_path(0))
+            parts = sorted(name for name in os.listdir(self._parts_dir) if name.endswith(".parquet"))
+            rows = sum(self._pq.ParquetFile(os.path.join(self._parts_dir, name)).metadata.num_rows for name in parts)
+        except Exception as e:
+            print(f"Could not read {self.path} to resume, starting over: {str(e)}")
+            return False
+        if parts != [os.path.basename(self._part_path(i)) for i in range(len(parts))] or rows != self.rows_written:
+            print(f"{self.path} does not match its manifest ({rows} rows, {self.rows_written} recorded), starting over")
+            return False
+        self._parts = len(parts)
+        return True
+
+    def _part_path(self, number):
+        return os.path.join(self._parts_dir, f"part-{number:06d}.parquet")
+
+    def _write_row_group(self):
+        if self._row_group:
+            strings = [c for c in self.columns if self._schema.field(c).type == self._pa.string()]
+            rows = [{**row, **{c: _as_text(row.get(c)) for c in strings}} for row in self._row_group]
+            # Written under a temporary name so a part file is either complete or absent
+            part_path = self._part_path(self._parts)
+            self._pq.write_table(self._pa.Table.from_pylist(rows, schema=self._schema), part_path + ".tmp")
+            os.replace(part_path + ".tmp", part_path)
+            self._parts += 1
+            self.rows_written += len(self._row_group)
+            self._row_group = []
+        # Parquet rows only count as done once their part file is on disk
+        self._record()
+
+    def _record(self):
+        if self.manifest is not None and self._unrecorded:
+            results_bytes = self._file.tell() if self._file is not None else 0
+            self.manifest.record(self._unrecorded, self.rows_written, results_bytes)
+        self._unrecorded = []
+
+    def close(self):
+        if self.file_format == "parquet":
+            self._write_row_group()
+            if self._parts:
+                # Until the joined file replaces path, the parts remain the record of the run
+                with self._pq.ParquetWriter(self.path + ".tmp", self._schema) as writer:
+                    for number in range(self._parts):
+                        writer.write_table(self._pq.read_table(self._part_path(number), schema=self._schema))
+                os.replace(self.path + ".tmp", self.path)
+            shutil.rmtree(self._parts_dir, ignore_errors=True)
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _iter_result_rows(path, file_format):
+    # The rows of a results file exactly as ResultWriter wrote them, in file order
+    if file_format == "parquet":
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            if file_format == "csv":
+                yield from csv.DictReader(f)
+            else:
+                for line in f:
+                    yield json.loads(line)
+
+def replace_result_rows(path, manifest, replacements, expected_fields=EXPECTED_JSON_FIELDS, extra_columns=()):
+    # Swaps rows of a finished (or interrupted) results file for new ones, e.g. retries of the
+    # rows that failed. replacements maps row index -> row; None keeps the old row. The file is
+    # rewritten beside path and only replaces it once complete, then the manifest is updated.
+    file_format = result_file_format(path)
+    old_rows = _iter_result_rows(path, file_format)
+    statuses = []
+    old_count = 0
+    with ResultWriter(path + ".retry", expected_fields, file_format=file_format, extra_columns=extra_columns) as writer:
+        for index in range(manifest.next_index):
+            # Rows that errored without a result were never written
+            old = next(old_rows, None) if manifest.statuses[index] != "error" else None
+            old_count += old is not None
+            row = replacements.get(index)
+            if row is None:
+                row = old
+            if row is not None:
+                statuses.append((index, row.get("Status") or "done"))
+            writer.add(index, row)
+    if next(old_rows, None) is not None or old_count != manifest.rows_written:
+        os.remove(path + ".retry")
+        raise ValueError(f"{path} does not match its manifest; rerun without --resume to start over")
+    os.replace(path + ".retry", path)
+    manifest.record(statuses, writer.rows_written, os.path.getsize(path) if file_format != "parquet" else 0)
+    return writer.rows_written
+
+def run_config_hash(jobs, **settings):
+    # Identifies a bulk run: the images, their prompts and distortions, and every setting
+    # that changes the answers. A manifest is only resumed by a run with the same hash.
+    digest = hashlib.sha256()
+    overlay_hashes = {}
+    for job in jobs:
+        file = job["file"]
+        if isinstance(file, str):
+            size = os.path.getsize(file) if os.path.exists(file) else None
+        else:
+            size = getattr(file, "size", None)
+        distortions = []
+        for d in job["distortions"]:
+            d = dict(d)
+            overlay = d.get("overlay_image")
+            if isinstance(overlay, Image.Image):
+                if id(overlay) not in overlay_hashes:
+                    overlay_hashes[id(overlay)] = hashlib.sha256(overlay.tobytes()).hexdigest()
+                d["overlay_image"] = overlay_hashes[id(overlay)]
+            elif isinstance(overlay, (bytes, bytearray)):
+                d["overlay_image"] = hashlib.sha256(overlay).hexdigest()
+            distortions.append(d)
+        digest.update(json.dumps([job["file_name"], size, job["input_text"], distortions], sort_keys=True, default=str).encode("utf-8"))
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+class RunManifest:
+    # On-disk record of a bulk run: its configuration hash and the status of every image
+    # written so far. Opening a manifest whose hash matches resumes it; otherwise it starts over.
+    # The manifest file itself only holds the small header; statuses are appended to
+    # path + ".log", one line per record() call, so recording a row costs the same at row
+    # 100,000 as at row 1.
+    def __init__(self, path, config_hash, total, resume=True):
+        self.path = path
+        self.log_path = path + ".log"
+        self.config_hash = config_hash
+        self.total = total
+        self.resumed = False
+
+        if resume and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                saved = None
+            if saved and saved.get("config_hash") == config_hash and saved.get("total") == total:
+                self._replay_log()
+                self.resumed = self.next_index > 0
+        if not self.resumed:
+            self.reset()
+
+    def _replay_log(self):
+        self.statuses = [None] * self.total
+        self.next_index = 0
+        self.rows_written = 0
+        self.results_bytes = 0
+        valid_bytes = 0
+        try:
+            with open(self.log_path, "rb") as f:
+                for line in f:
+                    # A crash mid-append leaves a partial last line; everything before it stands
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        statuses, rows_written, results_bytes = json.loads(line)
+                    except ValueError:
+                        break
+                    self._apply(statuses, rows_written, results_bytes)
+                    valid_bytes += len(line)
+        except OSError:
+            return
+        if valid_bytes != os.path.getsize(self.log_path):
+            with open(self.log_path, "r+b") as f:
+                f.truncate(valid_bytes)
+
+    def reset(self):
+        self.statuses = [None] * self.total
+        self.next_index = 0
+        self.rows_written = 0
+        self.results_bytes = 0
+        self.resumed = False
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The log is emptied before the new header lands, so a crash in between never pairs
+        # a stale log with the new configuration
+        open(self.log_path, "w").close()
+        # Written to a temporary file first so a crash never leaves a half-written header
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"config_hash": self.config_hash, "total": self.total}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    @property
+    def complete(self):
+        return self.next_index >= self.total
+
+    def _apply(self, statuses, rows_written, results_bytes):
+        for index, status in statuses:
+            self.statuses[index] = status
+            self.next_index = max(self.next_index, index + 1)
+        self.rows_written = rows_written
+        self.results_bytes = results_bytes
+
+    def record(self, statuses, rows_written, results_bytes):
+        statuses = [[index, status] for index, status in statuses]
+        self._apply(statuses, rows_written, results_bytes)
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps([statuses, rows_written, results_bytes]) + "\n")
+
+def _as_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+# Folder mode previews: small thumbnails decoded once per image and kept on disk
+THUMBNAIL_SIZE = PREVIEW_LONG_EDGE
+
+class ThumbnailIndex:
+    # On-disk index of pre-decoded thumbnails and basic metadata (dimensions, format),
+    # keyed by path, mtime and size so an edited file gets a fresh entry. Once a folder
+    # has been indexed, previews never need to decode the originals again.
+    def __init__(self, cache_dir, size=THUMBNAIL_SIZE):
+        self.cache_dir = cache_dir
+        self.size = size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, path):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.size}"
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def build(self, paths, max_workers=8):
+        # Generates the missing thumbnails in parallel; returns {path: metadata}
+        entries = {}
+        missing = []
+        for path in paths:
+            entry = self._load_metadata(path)
+            if entry is None:
+                missing.append(path)
+            else:
+                entries[path] = entry
+        for i, entry, error in run_concurrently(self._create, missing, max_workers=max_workers):
+            if error is None:
+                entries[missing[i]] = entry
+            else:
+                print(f"Could not create a thumbnail for {missing[i]}: {str(error)}")
+        return entries
+
+    def metadata(self, path):
+        return self._load_metadata(path) or self._create(path)
+
+    def thumbnail(self, path):
+        entry_path = self._entry_path(path)
+        if not os.path.exists(entry_path + ".png"):
+            self._create(path)
+        with Image.open(entry_path + ".png") as thumbnail:
+            thumbnail.load()
+            return thumbnail
+
+    def _load_metadata(self, path):
+        try:
+            with open(self._entry_path(path) + ".json", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _create(self, path):
+        entry_path = self._entry_path(path)
+        with Image.open(path) as image:
+            metadata = {"width": image.width, "height": image.height, "format": image.format, "mode": image.mode}
+            # Lets the JPEG decoder scale down while decoding
+            image.draft("RGB", (self.size, self.size))
+            thumbnail = image if image.mode in ("RGB", "RGBA", "L") else image.convert("RGBA")
+            thumbnail.thumbnail((self.size, self.size), Image.LANCZOS, reducing_gap=3.0)
+            thumbnail.save(entry_path + ".png.tmp", format="PNG")
+        metadata["thumbnail_width"], metadata["thumbnail_height"] = thumbnail.size
+        # Temporary files plus os.replace keep half-written entries out of the index
+        os.replace(entry_path + ".png.tmp", entry_path + ".png")
+        with open(entry_path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+        os.replace(entry_path + ".json.tmp", entry_path + ".json")
+        return metadata
@@ -0,0 +1,275 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import Mock, patch
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import numpy as np
+import PIL
+from PIL import Image
+import src.utils as utils_module
+from src.utils import apply_distortions, run_bulk_analysis, EXPECTED_JSON_FIELDS
+
+# Timing and peak memory of the distortion kernels and of a bulk run against a stubbed model.
+#   python -m tests.benchmarks.run_benchmarks --output tests/benchmarks/baseline.json
+#   python -m tests.benchmarks.run_benchmarks --baseline tests/benchmarks/baseline.json
+# The second command exits with status 1 when a case is slower (or uses more memory)
+# than the baseline by more than the thresholds. Baselines are only comparable on the same machine.
+# Memory is measured twice: tracemalloc's peak during one run, and the peak resident size of
+# a fresh process that runs only that case, over its imports and input (this also counts the
+# buffers PIL allocates).
+
+SIZES = {"720p": (1280, 720), "1080p": (1920, 1080), "4k": (3840, 2160)}
+
+WARP_PARAMS = {"wave_amplitude": 20.0, "wave_frequency": 0.04, "bulge_factor": 30.0}
+
+@functools.lru_cache(maxsize=4)
+def make_image(size, seed=0):
+    # Deterministic stand-in for a road scene: a sky-to-road gradient with noise
+    width, height = size
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(200, 60, height, dtype=np.float32)[:, None, None]
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    # Made in bands (drawing the same noise as one call would) so the float temporaries
+    # do not inflate the peak resident size the cases are measured against
+    for top in range(0, height, 64):
+        band = gradient[top:top + 64] + rng.normal(0, 25, (min(64, height - top), width, 3)).astype(np.float32)
+        pixels[top:top + 64] = np.clip(band, 0, 255)
+    return Image.fromarray(pixels, mode="RGB")
+
+def make_overlay(seed=1):
+    rng = np.random.default_rng(seed)
+    overlay = Image.fromarray(rng.integers(0, 256, (300, 300, 4), dtype=np.uint8), mode="RGBA")
+    buffer = io.BytesIO()
+    overlay.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def distortion_cases():
+    overlay = make_overlay()
+    cases = {
+        "Blur": [{"type": "Blur", "intensity": 0.5}],
+        "Brightness": [{"type": "Brightness", "intensity": 0.5}],
+        "Contrast": [{"type": "Contrast", "intensity": 0.5}],
+        "Sharpness": [{"type": "Sharpness", "intensity": 0.5}],
+        "Color": [{"type": "Color", "saturation": 1.5, "hue_shift": 0.2}],
+        "Rain": [{"type": "Rain", "intensity": 0.5, "seed": 1}],
+        "Overlay": [{"type": "Overlay", "intensity": 0.5, "overlay_image": overlay}],
+        "Warp": [{"type": "Warp", "intensity": 0.5, "warp_params": WARP_PARAMS}],
+    }
+    # Chains the app is commonly used with
+    cases["Rain+Blur"] = cases["Rain"] + cases["Blur"]
+    cases["Brightness+Contrast+Color"] = cases["Brightness"] + cases["Contrast"] + cases["Color"]
+    cases["Warp+Rain+Overlay"] = cases["Warp"] + cases["Rain"] + cases["Overlay"]
+    return cases
+
+def clear_caches():
+    utils_module.clear_warp_cache()
+    utils_module.clear_overlay_cache()
+    utils_module.clear_rain_cache()
+    utils_module.clear_preview_cache()
+
+@contextlib.contextmanager
+def quiet():
+    # The distortion functions print debug lines on every call
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def measure(func, repeat):
+    # Cold time (empty caches), median and best of `repeat` warm runs, and the peak of memory
+    # traced during one more warm run. tracemalloc sees Python and NumPy allocations, not
+    # the pixel buffers PIL allocates itself.
+    clear_caches()
+    start = time.perf_counter()
+    func()
+    cold = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": statistics.median(times), "min_seconds": min(times), "cold_seconds": cold, "peak_bytes": peak}
+
+def selected(name, name_filter, only):
+    return (not name_filter or name_filter in name) and (not only or name == only)
+
+def benchmark_distortions(sizes, repeat, name_filter=None, only=None):
+    results = {}
+    cases = distortion_cases()
+    for size_name in sizes:
+        if only and f"/{size_name}" not in only:
+            continue
+        image = make_image(SIZES[size_name])
+        for case_name, distortions in cases.items():
+            for compiled in (False, True):
+                name = f"distortions/{case_name}/{size_name}" + ("/compiled" if compiled else "")
+                if not selected(name, name_filter, only):
+                    continue
+                with quiet():
+                    results[name] = measure(lambda: apply_distortions(image, distortions, compiled=compiled), repeat)
+                print(f"{name:50s} {results[name]['seconds'] * 1000:9.1f} ms {results[name]['peak_bytes'] / 2**20:8.1f} MB")
+    return results
+
+def benchmark_bulk(image_count, latency, repeat, name_filter=None, only=None):
+    # End-to-end bulk run: images on disk, distorted, encoded and sent to a model stub that
+    # answers after `latency` seconds, with and without the process pipeline
+    results = {}
+    response = 'Clear road. ===JSON==={"road_conditions": "dry"}===JSON==='
+
+    def generate_content(*args, **kwargs):
+        time.sleep(latency)
+        return Mock(text=response)
+
+    model = Mock()
+    model.generate_content.side_effect = generate_content
+    distortions = [{"type": "Rain", "intensity": 0.5, "seed": 1}, {"type": "Blur", "intensity": 0.2}]
+    with tempfile.TemporaryDirectory() as folder, patch("google.generativeai.GenerativeModel", return_value=model):
+        jobs = []
+        for i in range(image_count):
+            path = os.path.join(folder, f"{i}.jpg")
+            make_image(SIZES["720p"], seed=i).save(path, quality=90)
+            jobs.append({"file": path, "file_name": f"{i}.jpg", "distortions": distortions, "input_text": "Prompt"})
+
+        for name, options in [("bulk/threads", {}), ("bulk/pipeline", {"cpu_workers": min(4, os.cpu_count() or 1)})]:
+            if not selected(name, name_filter, only):
+                continue
+
+            def run():
+                utils_module.clear_model_pool()
+                for _, _, error in run_bulk_analysis(jobs, "benchmark-model", None, EXPECTED_JSON_FIELDS,
+                                                     max_workers=4, **options):
+                    if error is not None:
+                        raise error
+
+            with quiet():
+                results[name] = measure(run, repeat)
+            results[name]["images_per_minute"] = image_count * 60 / results[name]["seconds"]
+            print(f"{name:50s} {results[name]['seconds'] * 1000:9.1f} ms {results[name]['images_per_minute']:8.1f} images/min")
+    return results
+
+def max_rss_bytes():
+    # Linux keeps the parent's ru_maxrss across fork and exec, so the high-water mark of this
+    # process's own memory is read from /proc where it exists
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def peak_rss(name, bulk_images, bulk_latency):
+    # How far a fresh process that runs only this case grows its peak resident size past
+    # its imports and input image, or None where the resource module is not available
+    if resource is None:
+        return None
+    command = [sys.executable, "-m", "tests.benchmarks.run_benchmarks", "--only", name, "--repeat", "1",
+               "--bulk-images", str(bulk_images), "--bulk-latency", str(bulk_latency), "--report-rss"]
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.run(command, cwd=root, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])["peak_rss_bytes"]
+
+def run_benchmarks(sizes=("720p", "1080p", "4k"), repeat=3, bulk_images=16, bulk_latency=0.2, name_filter=None,
+                   only=None, rss=True):
+    results = benchmark_distortions(sizes, repeat, name_filter, only)
+    if bulk_images:
+        results.update(benchmark_bulk(bulk_images, bulk_latency, repeat, name_filter, only))
+    if rss and resource is not None:
+        for name, result in results.items():
+            result["peak_rss_bytes"] = peak_rss(name, bulk_images, bulk_latency)
+            print(f"{name:50s} {result['peak_rss_bytes'] / 2**20:9.1f} MB peak resident growth")
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+def compare_results(current, baseline, time_threshold=1.25, memory_threshold=1.25):
+    # Cases present in both runs whose median time or peak memory grew by more than the
+    # thresholds (ratios, so 1.25 allows 25% slower)
+    regressions = []
+    for name, result in current["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        for key, threshold in (("seconds", time_threshold), ("peak_bytes", memory_threshold),
+                               ("peak_rss_bytes", memory_threshold)):
+            if previous.get(key) and result.get(key) and result[key] > previous[key] * threshold:
+                regressions.append((name, key, previous[key], result[key]))
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the distortion kernels and the bulk pipeline.")
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=3, help="Warm runs timed per case")
+    parser.add_argument("--filter", help="Only run cases whose name contains this text, e.g. Warp or bulk")
+    parser.add_argument("--bulk-images", type=int, default=16, help="Images in the end-to-end run (0 to skip it)")
+    parser.add_argument("--bulk-latency", type=float, default=0.2, help="Seconds the stubbed model takes to answer")
+    parser.add_argument("--output", help="Write the results to this JSON file (e.g. to save a baseline)")
+    parser.add_argument("--baseline", help="Compare against the results in this JSON file")
+    parser.add_argument("--time-threshold", type=float, default=1.25, help="Allowed slowdown ratio")
+    parser.add_argument("--memory-threshold", type=float, default=1.25, help="Allowed peak memory growth ratio")
+    parser.add_argument("--no-rss", action="store_true",
+                        help="Skip the per-case subprocesses that measure peak resident memory")
+    # Used by peak_rss to run a single case in a fresh process
+    parser.add_argument("--only", help=argparse.SUPPRESS)
+    parser.add_argument("--report-rss", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.report_rss:
+        # The growth of the high-water mark past the imported modules and the input image
+        # is what the case used
+        if args.only.startswith("distortions/"):
+            make_image(SIZES[args.only.split("/")[2]])
+        before = max_rss_bytes()
+        run_benchmarks(args.sizes, args.repeat, args.bulk_images, args.bulk_latency, only=args.only, rss=False)
+        print(json.dumps({"peak_rss_bytes": max_rss_bytes() - before}))
+        return 0
+    current = run_benchmarks(args.sizes, args.repeat, args.bulk_images, args.bulk_latency, args.filter,
+                             rss=not args.no_rss)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"Wrote {len(current['results'])} results to {args.output}")
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_results(current, baseline, args.time_threshold, args.memory_threshold)
+    for name, key, previous, now in regressions:
+        print(f"REGRESSION {name} {key}: {previous:.4g} -> {now:.4g} ({now / previous:.2f}x)", file=sys.stderr)
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,71 @@
 import pytest
-from PIL import Image
+from PIL import Image, ImageEnhance
 import io
+import os
+import threading
+import time
 import numpy as np
+import pandas as pd
+import src.utils as utils_module
 from src.utils import (
     apply_distortion,
     shift_hue,
     apply_rain_effect,
+    assign_rain_variants,
+    clear_rain_cache,
+    get_rain_cache_stats,
     apply_overlay,
     apply_warp_effect,
     apply_distortions,
-    get_gemini_response
+    apply_color_adjustments,
+    adjust_saturation,
+    get_gemini_response,
+    describe_distortions,
+    run_concurrently,
+    run_bulk_analysis,
+    prepare_bulk_image,
+    stage_percentiles,
+    STAGE_COLUMNS,
+    expand_distortion_grid,
+    sweep_distortions,
+    run_sweep_analysis,
+    discover_images,
+    ResponseCache,
+    encode_image_payload,
+    get_gemini_packed_response,
+    call_with_retries,
+    classify_api_error,
+    CircuitBreaker,
+    ResultWriter,
+    ThumbnailIndex,
+    cached_distortions,
+    proxy_image,
+    scale_distortions,
+    clear_preview_cache,
+    clear_overlay_cache,
+    get_overlay_cache_stats,
+    compile_distortions,
+    get_preview_cache_stats,
+    RunManifest,
+    run_config_hash,
+    read_results,
+    bulk_result,
+    build_response_schema,
+    clear_model_pool,
+    clear_warp_cache,
+    get_warp_cache_stats,
+    set_warp_cache_limit
 )
 import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+from unittest.mock import Mock
+
+@pytest.fixture(autouse=True)
+def fresh_model_pool():
+    # Pooled models would otherwise leak mocks from one test into the next
+    clear_model_pool()
+    yield
+    clear_model_pool()
 
 def create_test_image(size=(100, 100), color='red'):
     return Image.new('RGB', size, color=color)
@@ -104,6 +158,42 @@ def test_apply_warp_effect():
     assert result.size == image.size
     assert result.mode == 'RGB'
 
+def test_warp_cache_reuses_maps():
+    clear_warp_cache()
+    warp_params = {'wave_amplitude': 20, 'wave_frequency': 0.05, 'bulge_factor': 30}
+    first = apply_warp_effect(create_test_image(color='green'), 0.5, warp_params)
+    second = apply_warp_effect(create_test_image(color='green'), 0.5, warp_params)
+    stats = get_warp_cache_stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+    assert np.array_equal(np.array(first), np.array(second))
+
+def test_warp_cache_respects_limit():
+    clear_warp_cache()
+    set_warp_cache_limit(0)
+    try:
+        warp_params = {'wave_amplitude': 20, 'wave_frequency': 0.05, 'bulge_factor': 30}
+        apply_warp_effect(create_test_image(), 0.5, warp_params)
+        assert get_warp_cache_stats()["entries"] == 0
+    finally:
+        set_warp_cache_limit(512 * 1024 * 1024)
+
+def test_apply_warp_effect_tiled_matches():
+    image = Image.fromarray(np.random.default_rng(1).integers(0, 255, (70, 90, 3), dtype=np.uint8))
+    warp_params = {'wave_amplitude': 20, 'wave_frequency': 0.05, 'bulge_factor': 30}
+    expected = np.array(apply_warp_effect(image, 0.5, warp_params)).astype(int)
+    result = apply_warp_effect(image, 0.5, warp_params, tiled=True, tile_rows=16)
+    assert result.size == image.size
+    assert result.mode == 'RGB'
+    assert np.abs(np.array(result).astype(int) - expected).max() <= 1
+
+    # The compiled pipeline honours the flag and never builds the full coordinate map
+    clear_warp_cache()
+    warp = [{'type': 'Warp', 'intensity': 0.5, 'warp_params': warp_params, 'tiled': True, 'tile_rows': 16}]
+    compiled = apply_distortions(image, warp, compiled=True)
+    assert compiled.tobytes() == result.tobytes()
+    assert get_warp_cache_stats()["entries"] == 0
+
 def test_apply_distortions():
     image = create_test_image()
     distortions = [
@@ -116,6 +206,80 @@ def test_apply_distortions():
     assert result.size == image.size
     assert result.mode == 'RGB'
 
+def test_apply_distortions_compiled_matches():
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (60, 80, 3), dtype=np.uint8))
+    overlay = create_test_image(size=(30, 30), color='blue')
+    distortions = [
+        {'type': 'Brightness', 'intensity': 0.3},
+        {'type': 'Contrast', 'intensity': 0.5},
+        {'type': 'Color', 'saturation': 1.5, 'hue_shift': 0.1},
+        {'type': 'Rain', 'intensity': 0.5, 'seed': 3},
+        {'type': 'Overlay', 'intensity': 0.4, 'overlay_image': overlay},
+        {'type': 'Warp', 'intensity': 0.5, 'warp_params': {'wave_amplitude': 20, 'wave_frequency': 0.05, 'bulge_factor': 30}},
+        {'type': 'Blur', 'intensity': 0.1},
+    ]
+    expected = np.array(apply_distortions(image, distortions)).astype(int)
+    result = apply_distortions(image, distortions, compiled=True)
+    assert isinstance(result, Image.Image)
+    assert result.mode == 'RGB'
+    assert np.abs(np.array(result).astype(int) - expected).max() <= 1
+
+def test_apply_color_adjustments_matches_chain():
+    image = Image.fromarray(np.random.default_rng(2).integers(0, 255, (50, 70, 3), dtype=np.uint8))
+    distortions = [
+        {'type': 'Brightness', 'intensity': 0.3},
+        {'type': 'Contrast', 'intensity': 0.5},
+        {'type': 'Color', 'saturation': 1.5, 'hue_shift': 0.1},
+    ]
+    # Baseline: PIL's enhancers one step at a time
+    expected = ImageEnhance.Brightness(image).enhance(1.3)
+    expected = ImageEnhance.Contrast(expected).enhance(1.5)
+    expected = shift_hue(ImageEnhance.Color(expected).enhance(1.5), 0.1)
+    # The default pipeline is exactly the baseline, including a Color step with no hue shift
+    assert apply_distortions(image, distortions).tobytes() == expected.tobytes()
+    desaturate = [{'type': 'Color', 'saturation': 0.3, 'hue_shift': 0.0}]
+    assert apply_distortions(image, desaturate).tobytes() == shift_hue(ImageEnhance.Color(image).enhance(0.3), 0.0).tobytes()
+
+    result = apply_color_adjustments(image, distortions)
+    assert result.mode == 'RGB'
+    assert np.abs(np.array(result).astype(int) - np.array(expected).astype(int)).max() <= 1
+
+    # The saturation matrix the compiled pipeline uses without a hue shift stays within 1 level
+    for factor in (0.0, 0.5, 1.5, 3.0):
+        enhanced = np.array(ImageEnhance.Color(image).enhance(factor)).astype(int)
+        assert np.abs(np.array(adjust_saturation(image, factor)).astype(int) - enhanced).max() <= 1
+
+def test_describe_distortions():
+    distortions = [
+        {'type': 'Blur', 'intensity': 0.5},
+        {'type': 'Color', 'saturation': 1.5, 'hue_shift': 0.1},
+    ]
+    assert describe_distortions(distortions) == "Blur (Intensity: 0.50), Color (Saturation: 1.50, Hue Shift: 0.10)"
+
+def test_run_concurrently_reports_every_item():
+    def square(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return x * x
+
+    outcomes = {index: (result, error) for index, result, error in run_concurrently(square, range(6), max_workers=3)}
+    assert sorted(outcomes) == list(range(6))
+    assert outcomes[2] == (4, None)
+    assert isinstance(outcomes[3][1], ValueError)
+
+    # Items are pulled from a generator only as workers free up
+    pulled = []
+
+    def items():
+        for i in range(100):
+            pulled.append(i)
+            yield i
+
+    results = run_concurrently(square, items(), max_workers=2)
+    next(results)
+    assert len(pulled) <= 5
+    results.close()
+
 def test_get_gemini_response(mocker):
     # Mock the GenerativeModel
     mock_model = mocker.Mock()
@@ -162,6 +326,19 @@ def test_apply_rain_effect_zero_intensity():
     result = apply_rain_effect(image, 0)
     assert np.array_equal(np.array(result), np.array(image))  # Should be identical to original
 
+def test_apply_rain_effect_seed_is_reproducible():
+    image = create_test_image(color='black')
+    first = apply_rain_effect(image, 0.5, seed=42)
+    second = apply_rain_effect(image, 0.5, seed=42)
+    assert np.array_equal(np.array(first), np.array(second))
+    assert np.array(first).any()  # Rain streaks should be visible on black
+
+def test_apply_rain_effect_fast_path_matches():
+    image = create_test_image(color='blue')
+    regular = np.array(apply_rain_effect(image, 0.5, seed=7)).astype(int)
+    fast = np.array(apply_rain_effect(image, 0.5, seed=7, fast=True)).astype(int)
+    assert np.abs(regular - fast).max() <= 1
+
 def test_apply_overlay_null_overlay():
     image = create_test_image()
     result = apply_overlay(image, 0.5, None)
@@ -187,4 +364,653 @@ def test_get_gemini_response_error_handling(mocker):
     text_response, json_response = get_gemini_response(input_text, image, model_name, system_instructions, expected_fields)
 
     assert "Error generating response" in text_response
-    assert "error" in json_response
\ No newline at end of file
+    assert "error" in json_response
+
+def test_get_gemini_response_uses_cache(mocker, tmp_path):
+    mock_model = mocker.Mock()
+    mock_response = mocker.Mock()
+    mock_response.text = 'Looks safe ===JSON==={"overall_safety": "good"}===JSON==='
+    mock_model.generate_content.return_value = mock_response
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+
+    first = get_gemini_response("Prompt", create_test_image(), "test-model", None, ["overall_safety"], cache=cache)
+    second = get_gemini_response("Prompt", create_test_image(), "test-model", None, ["overall_safety"], cache=cache)
+    assert first == second == ("Looks safe", {"overall_safety": "good"})
+    mock_model.generate_content.assert_called_once()
+
+    get_gemini_response("Prompt", create_test_image(), "test-model", None, ["overall_safety"], cache=cache, refresh_cache=True)
+    assert mock_model.generate_content.call_count == 2
+
+def test_response_cache_eviction_and_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=40)
+    cache.put("a", "x" * 20, {})
+    cache.put("b", "y" * 20, {})
+    assert cache.get("a") is None  # Evicted to stay under max_bytes
+    assert cache.get("b") == ("y" * 20, {})
+
+    cache.ttl_seconds = -1
+    assert cache.get("b") is None
+
+def test_encode_image_payload_formats():
+    image = create_test_image(size=(400, 200))
+    png_bytes, png_mime = encode_image_payload(image)
+    assert png_mime == "image/png"
+    assert Image.open(io.BytesIO(png_bytes)).size == (400, 200)
+
+    jpeg_bytes, jpeg_mime = encode_image_payload(image, max_long_edge=100, image_format="jpeg", quality=70)
+    assert jpeg_mime == "image/jpeg"
+    assert Image.open(io.BytesIO(jpeg_bytes)).size == (100, 50)
+
+    webp_bytes, webp_mime = encode_image_payload(image.convert("RGBA"), image_format="WEBP")
+    assert webp_mime == "image/webp"
+    assert Image.open(io.BytesIO(webp_bytes)).format == "WEBP"
+
+    # Downscaling an unloaded JPEG leaves the caller's image at full size
+    buffer = io.BytesIO()
+    create_test_image(size=(1600, 1200)).save(buffer, format="JPEG")
+    jpeg = Image.open(buffer)
+    encode_image_payload(jpeg, max_long_edge=200, image_format="JPEG")
+    jpeg.load()
+    assert jpeg.size == (1600, 1200)
+
+def test_get_gemini_response_reports_payload(mocker):
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text="Test response ===JSON==={}===JSON===")
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+
+    stats = {}
+    get_gemini_response("Test input", create_test_image(size=(300, 300)), "test-model", None, ["field1"],
+                        max_long_edge=64, image_format="JPEG", stats=stats)
+    content = mock_model.generate_content.call_args[0][0]
+    assert content[-1]["mime_type"] == "image/jpeg"
+    assert stats["payload_bytes"] == len(content[-1]["data"])
+    assert stats["encode_seconds"] >= 0
+
+def test_get_gemini_response_reuses_model(mocker):
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text="Test response ===JSON==={}===JSON===")
+    model_class = mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+
+    for _ in range(3):
+        get_gemini_response("Test input", create_test_image(), "test-model", "Test instructions", ["field1"])
+
+    model_class.assert_called_once()
+    assert "Test instructions" in model_class.call_args.kwargs["system_instruction"]
+    assert "field1" in model_class.call_args.kwargs["system_instruction"]
+    content = mock_model.generate_content.call_args[0][0]
+    assert content[0] == "Test input"  # Instructions are no longer sent as content
+
+def test_get_gemini_packed_response_splits_answer(mocker):
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text=(
+        "===IMAGE 1===\nFirst scene.\n===IMAGE 2===\nSecond scene.\n"
+        '===JSON===[{"image": "1", "road_conditions": "dry"}, {"image": 2, "road_conditions": "wet"}]===JSON==='
+    ))
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+
+    stats = [{}, {}]
+    responses = get_gemini_packed_response("Prompt", [create_test_image(), create_test_image(color='blue')],
+                                           "test-model", None, ["road_conditions"], stats=stats)
+    assert responses == [("First scene.", {"road_conditions": "dry"}), ("Second scene.", {"road_conditions": "wet"})]
+    assert all(image_stats["packed"] for image_stats in stats)
+    mock_model.generate_content.assert_called_once()
+
+def test_get_gemini_packed_response_uses_cache(mocker, tmp_path):
+    mock_model = mocker.Mock()
+    mock_model.generate_content.side_effect = [
+        mocker.Mock(text=("===IMAGE 1===\nFirst scene.\n===IMAGE 2===\nSecond scene.\n"
+                          '===JSON===[{"image": 1, "road_conditions": "dry"}, {"image": 2, "road_conditions": "wet"}]===JSON===')),
+        mocker.Mock(text='Third scene. ===JSON==={"road_conditions": "icy"}===JSON==='),
+    ]
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    images = [create_test_image(), create_test_image(color='blue'), create_test_image(color='green')]
+
+    first = get_gemini_packed_response("Prompt", images[:2], "test-model", None, ["road_conditions"], cache=cache)
+    # Only the new image is requested, on its own; the split answers are cached per image
+    stats = [{}, {}, {}]
+    second = get_gemini_packed_response("Prompt", images, "test-model", None, ["road_conditions"], cache=cache, stats=stats)
+    assert second == first + [("Third scene.", {"road_conditions": "icy"})]
+    assert mock_model.generate_content.call_count == 2
+    assert [image_stats["packed"] for image_stats in stats] == [False, False, False]
+    # ...under the same key a single request uses
+    assert get_gemini_response("Prompt", images[1], "test-model", None, ["road_conditions"], cache=cache) == first[1]
+    assert mock_model.generate_content.call_count == 2
+
+def test_get_gemini_packed_response_falls_back(mocker):
+    packed_model = mocker.Mock()
+    packed_model.generate_content.return_value = mocker.Mock(text="Not the requested format")
+    single_model = mocker.Mock()
+    single_model.generate_content.return_value = mocker.Mock(text='Fine ===JSON==={"road_conditions": "dry"}===JSON===')
+    mocker.patch('google.generativeai.GenerativeModel', side_effect=[packed_model, single_model])
+
+    responses = get_gemini_packed_response("Prompt", [create_test_image(), create_test_image()],
+                                           "test-model", None, ["road_conditions"])
+    assert responses == [("Fine", {"road_conditions": "dry"})] * 2
+    assert single_model.generate_content.call_count == 2
+
+def test_get_gemini_response_structured_output(mocker):
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text='{"response": "Wet road.", "road_conditions": "wet", "weather_conditions": ""}')
+    model_class = mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+
+    text_response, json_response = get_gemini_response("Prompt", create_test_image(), "test-model", None,
+                                                       ["road_conditions", "weather_conditions"], structured_output=True)
+    assert text_response == "Wet road."
+    assert json_response == {"road_conditions": "wet"}
+    generation_config = model_class.call_args.kwargs["generation_config"]
+    assert generation_config["response_mime_type"] == "application/json"
+    assert generation_config["response_schema"] == build_response_schema(["road_conditions", "weather_conditions"])
+
+def test_get_gemini_response_structured_output_falls_back(mocker):
+    structured_model = mocker.Mock()
+    structured_model.generate_content.side_effect = Exception("response_schema not supported")
+    text_model = mocker.Mock()
+    text_model.generate_content.return_value = mocker.Mock(text='Dry road. ===JSON==={"road_conditions": "dry"}===JSON===')
+    mocker.patch('google.generativeai.GenerativeModel', side_effect=[structured_model, text_model])
+
+    text_response, json_response = get_gemini_response("Prompt", create_test_image(), "test-model", None,
+                                                       ["road_conditions"], structured_output=True)
+    assert text_response == "Dry road."
+    assert json_response == {"road_conditions": "dry"}
+
+def test_classify_api_error():
+    assert classify_api_error(api_exceptions.ResourceExhausted("quota")) == "rate_limit"
+    assert classify_api_error(api_exceptions.ServiceUnavailable("down")) == "server_error"
+    assert classify_api_error(api_exceptions.DeadlineExceeded("slow")) == "timeout"
+    assert classify_api_error(ValueError("bad request")) is None
+    # Other clients' errors count by HTTP status, not by what the message happens to say
+    assert classify_api_error(Mock(spec=Exception, code=503)) == "server_error"
+    assert classify_api_error(Mock(spec=Exception, code=None, status_code=429)) == "rate_limit"
+    assert classify_api_error(ValueError("no such file: frame_500.jpg")) is None
+    assert classify_api_error(api_exceptions.InvalidArgument("prompt mentions a 503 deadline")) is None
+
+def test_call_with_retries_backs_off_and_honours_retry_after():
+    delays = []
+    func = Mock(side_effect=[api_exceptions.ResourceExhausted("quota, retry_delay { seconds: 7 }"),
+                             api_exceptions.ServiceUnavailable("down"), "ok"])
+    stats = {}
+    assert call_with_retries(func, max_retries=3, base_delay=0.5, stats=stats, sleep=delays.append) == "ok"
+    assert stats["retries"] == 2
+    assert delays[0] == 7
+    assert 0 <= delays[1] <= 1.0
+
+    # A hint longer than the backoff cap is still waited out in full
+    delays = []
+    func = Mock(side_effect=[api_exceptions.ResourceExhausted("quota, retry_delay { seconds: 60 }"), "ok"])
+    assert call_with_retries(func, max_delay=30.0, sleep=delays.append) == "ok"
+    assert delays == [60]
+
+def test_call_with_retries_gives_up():
+    func = Mock(side_effect=api_exceptions.ServiceUnavailable("down"))
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        call_with_retries(func, max_retries=2, sleep=lambda delay: None)
+    assert func.call_count == 3
+
+    func = Mock(side_effect=ValueError("bad request"))
+    with pytest.raises(ValueError):
+        call_with_retries(func, max_retries=2, sleep=lambda delay: None)
+    assert func.call_count == 1
+
+def test_circuit_breaker_pauses_calls():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=5)
+    func = Mock(side_effect=[api_exceptions.ServiceUnavailable("down")] * 2 + ["ok"])
+    waits = []
+    assert call_with_retries(func, max_retries=2, base_delay=0, breaker=breaker, sleep=waits.append) == "ok"
+    assert breaker.trips == 1
+    assert max(waits) > 4  # Waited for the breaker to close again
+    assert breaker.state == "closed"
+
+def test_circuit_breaker_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.2)
+    breaker.record_failure()
+    calls = []
+    lock = threading.Lock()
+
+    def func():
+        with lock:
+            calls.append(breaker.state)
+            first = len(calls) == 1
+        time.sleep(0.1)
+        if first:
+            raise api_exceptions.ServiceUnavailable("down")
+        return "ok"
+
+    threads = [threading.Thread(target=call_with_retries, args=(func,), kwargs={"base_delay": 0, "breaker": breaker})
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # One trial fails and reopens the breaker, the next trial succeeds, then the rest go
+    assert len(calls) == 5 and breaker.trips == 2
+    assert calls[:2] == ["half_open", "half_open"] and calls[2:] == ["closed"] * 3
+
+def test_get_gemini_response_records_retries(mocker):
+    mocker.patch('src.utils.time.sleep')
+    mock_model = mocker.Mock()
+    mock_model.generate_content.side_effect = [api_exceptions.ServiceUnavailable("down"),
+                                               mocker.Mock(text='OK ===JSON==={"road_conditions": "dry"}===JSON===')]
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+
+    stats = {}
+    text_response, json_response = get_gemini_response("Prompt", create_test_image(), "test-model", None,
+                                                       ["road_conditions"], stats=stats)
+    assert json_response == {"road_conditions": "dry"}
+    assert stats["retries"] == 1 and stats["status"] == "ok"
+
+def test_batch_runner_writes_csv(mocker, tmp_path):
+    from src import batch
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text='Clear road. ===JSON==={"road_conditions": "dry"}===JSON===')
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+    mocker.patch('google.generativeai.configure')
+
+    for name in ("b.png", "a.jpg", "notes.txt"):
+        if name.endswith(".txt"):
+            (tmp_path / name).write_text("not an image")
+        else:
+            create_test_image().save(tmp_path / name)
+    output = tmp_path / "results.csv"
+
+    exit_code = batch.main([str(tmp_path), "--prompt", "Check the road", "--api-key", "test",
+                            "--distortions", '[{"type": "Blur", "intensity": 0.2}]', "--output", str(output)])
+    assert exit_code == 0
+    results = pd.read_csv(output)
+    assert list(results["Image"]) == ["a.jpg", "b.png"]
+    assert list(results.columns[:4]) == ["Image", "Distortions", "Input Text", "AI Response"]
+    assert list(results["road_conditions"]) == ["dry", "dry"]
+    assert results["Distortions"][0] == "Blur (Intensity: 0.20)"
+
+@pytest.mark.parametrize("extension", ["csv", "parquet"])
+def test_batch_runner_retries_failed_rows(mocker, tmp_path, extension):
+    from src import batch
+    ok = mocker.Mock(text='Clear road. ===JSON==={"road_conditions": "dry"}===JSON===')
+    mock_model = mocker.Mock()
+    mock_model.generate_content.side_effect = [ok, ValueError("invalid argument"), ok, ok]
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+    mocker.patch('google.generativeai.configure')
+    images = tmp_path / "images"
+    images.mkdir()
+    for name in ("a.png", "b.png", "c.png"):
+        create_test_image().save(images / name)
+    output = str(tmp_path / f"results.{extension}")
+    arguments = [str(images), "--api-key", "test", "--output", output, "--concurrency", "1", "--cpu-workers", "0",
+                 "--max-retries", "0"]
+
+    assert batch.main(arguments) == 1
+    assert list(read_results(output)["Status"]) == ["ok", "failed", "ok"]
+
+    # A plain resume leaves the failed row alone; --retry-failed replaces it in place
+    assert batch.main(arguments + ["--resume"]) == 1
+    assert mock_model.generate_content.call_count == 3
+    assert batch.main(arguments + ["--resume", "--retry-failed"]) == 0
+    results = read_results(output)
+    assert list(results["Image"]) == ["a.png", "b.png", "c.png"]
+    assert list(results["Status"]) == ["ok", "ok", "ok"]
+
+def make_result(name, road_conditions):
+    job = {"file_name": name, "distortions": [], "input_text": "Prompt"}
+    return bulk_result(job, f"Response for {name}", {"road_conditions": road_conditions}, {"status": "ok"}, ["road_conditions", "blind_spots"])
+
+@pytest.mark.parametrize("extension", ["csv", "jsonl"])
+def test_result_writer_streams_rows_in_order(tmp_path, extension):
+    path = str(tmp_path / f"results.{extension}")
+    with ResultWriter(path, ["road_conditions", "blind_spots"]) as writer:
+        writer.add(2, make_result("c.png", ["wet", "icy"]))
+        assert writer.rows_written == 0  # Held back until rows 0 and 1 arrive
+        writer.add(0, make_result("a.png", "dry"))
+        assert writer.rows_written == 1
+        writer.add(1, None)  # Failed row
+        assert writer.rows_written == 2
+
+    results = read_results(path, ["road_conditions", "blind_spots"])
+    assert list(results["Image"]) == ["a.png", "c.png"]
+    assert list(results["road_conditions"]) == ["dry", "wet, icy"]
+    assert "blind_spots" not in results.columns  # Empty columns are dropped when read back
+
+def test_result_writer_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "results.parquet")
+    with ResultWriter(path, ["road_conditions", "blind_spots"], row_group_size=1) as writer:
+        for i in range(3):
+            writer.add(i, make_result(f"{i}.png", "dry"))
+    results = read_results(path, ["road_conditions", "blind_spots"])
+    assert list(results["Image"]) == ["0.png", "1.png", "2.png"]
+
+def test_result_writer_parquet_resumes_after_crash(tmp_path):
+    pytest.importorskip("pyarrow")
+    fields = ["road_conditions", "blind_spots"]
+    rows = [make_result(f"{i}.png", "dry" if i % 2 else "wet") for i in range(7)]
+    jobs = [{"file": f"{i}.png", "file_name": f"{i}.png", "input_text": "Prompt", "distortions": []} for i in range(7)]
+    config_hash = run_config_hash(jobs, model="test-model")
+    path = str(tmp_path / "results.parquet")
+
+    def crash_after(count):
+        manifest = RunManifest(path + ".manifest.json", config_hash, len(rows))
+        writer = ResultWriter(path, fields, row_group_size=2, manifest=manifest)
+        for i in range(manifest.next_index, count):
+            writer.add(i, rows[i])
+        return manifest  # Never closed
+
+    assert crash_after(3).next_index == 2  # Row 2 was still in the open row group
+    assert crash_after(5).next_index == 4  # A resumed run that crashes too
+    manifest = RunManifest(path + ".manifest.json", config_hash, len(rows))
+    assert manifest.resumed and manifest.rows_written == 4
+    with ResultWriter(path, fields, row_group_size=2, manifest=manifest) as writer:
+        for i in range(manifest.next_index, len(rows)):
+            writer.add(i, rows[i])
+    assert list(read_results(path, fields)["Image"]) == [f"{i}.png" for i in range(7)]
+    assert not os.path.exists(path + ".parts")
+
+    # Reopening a finished run keeps its file
+    manifest = RunManifest(path + ".manifest.json", config_hash, len(rows))
+    assert manifest.complete
+    ResultWriter(path, fields, row_group_size=2, manifest=manifest).close()
+    assert len(read_results(path, fields)) == 7
+
+    # Parts that do not match the manifest are not trusted
+    os.remove(path + ".manifest.json")
+    crash_after(4)
+    os.remove(os.path.join(path + ".parts", "part-000001.parquet"))
+    manifest = RunManifest(path + ".manifest.json", config_hash, len(rows))
+    ResultWriter(path, fields, row_group_size=2, manifest=manifest)
+    assert manifest.next_index == 0 and manifest.rows_written == 0
+
+@pytest.mark.parametrize("extension", ["csv", "jsonl"])
+def test_run_manifest_resume_matches_uninterrupted_run(tmp_path, extension):
+    fields = ["road_conditions", "blind_spots"]
+    rows = [make_result(f"{i}.png", "dry" if i % 2 else "wet") for i in range(5)]
+    jobs = [{"file": f"{i}.png", "file_name": f"{i}.png", "input_text": "Prompt", "distortions": []} for i in range(5)]
+    config_hash = run_config_hash(jobs, model="test-model")
+
+    full_path = str(tmp_path / f"full.{extension}")
+    with ResultWriter(full_path, fields) as writer:
+        for i, row in enumerate(rows):
+            writer.add(i, row)
+
+    path = str(tmp_path / f"resumed.{extension}")
+    manifest = RunManifest(path + ".manifest.json", config_hash, len(rows))
+    writer = ResultWriter(path, fields, manifest=manifest)
+    writer.add(0, rows[0])
+    writer.add(1, rows[1])
+    writer.add(3, rows[3])  # Finished but never written, so not recorded
+    writer._file.write("half a row")  # The process dies mid-write
+    writer._file.close()
+    with open(path + ".manifest.json.log", "a", encoding="utf-8") as log:
+        log.write('[[[2, "ok"]], 3')  # ...or mid-append to the status log
+
+    manifest = RunManifest(path + ".manifest.json", config_hash, len(rows))
+    assert manifest.resumed and manifest.next_index == 2
+    assert manifest.statuses[:3] == ["ok", "ok", None]
+    with ResultWriter(path, fields, manifest=manifest) as writer:
+        for i in range(manifest.next_index, len(rows)):
+            writer.add(i, rows[i])
+    assert manifest.complete
+
+    with open(path, encoding="utf-8") as resumed, open(full_path, encoding="utf-8") as full:
+        assert resumed.read() == full.read()
+
+    # A different configuration does not pick up the old progress
+    other_hash = run_config_hash(jobs, model="other-model")
+    assert other_hash != config_hash
+    assert not RunManifest(path + ".manifest.json", other_hash, len(rows)).resumed
+
+def test_thumbnail_index_builds_once(mocker, tmp_path):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / f"{i}.jpg")
+        create_test_image(size=(1200, 900)).save(path)
+        paths.append(path)
+    index = ThumbnailIndex(str(tmp_path / "thumbnails"), size=64)
+
+    entries = index.build(paths)
+    assert entries[paths[0]]["width"] == 1200 and entries[paths[0]]["format"] == "JPEG"
+    assert index.thumbnail(paths[0]).size == (64, 48)
+
+    # Indexed images are served without opening the originals again
+    open_spy = mocker.spy(Image, "open")
+    assert index.build(paths) == entries
+    index.thumbnail(paths[1])
+    assert all(call.args[0] not in paths for call in open_spy.call_args_list)
+
+    # A changed file gets a new entry
+    create_test_image(size=(600, 600)).save(paths[2])
+    os.utime(paths[2], ns=(0, 10**9))
+    assert index.build(paths)[paths[2]]["width"] == 600
+
+def test_cached_distortions_recomputes_only_changed_settings(mocker):
+    clear_preview_cache()
+    apply_spy = mocker.spy(utils_module, "apply_distortions")
+    image = create_test_image(size=(64, 64))
+    warp = {"type": "Warp", "intensity": 0.5, "warp_params": {"wave_amplitude": 20.0, "wave_frequency": 0.04, "bulge_factor": 30.0}}
+
+    first = cached_distortions(image, [warp], "image-1")
+    # Same settings, rebuilt from scratch as on a Streamlit rerun
+    assert cached_distortions(image, [dict(warp, warp_params=dict(warp["warp_params"]))], "image-1") is first
+    assert apply_spy.call_count == 1
+
+    cached_distortions(image, [dict(warp, intensity=0.6)], "image-1")
+    cached_distortions(image, [warp], "image-2")
+    assert apply_spy.call_count == 3
+    assert get_preview_cache_stats()["hits"] == 1
+    clear_preview_cache()
+
+def test_proxy_image_and_scaled_distortions(tmp_path):
+    path = str(tmp_path / "large.jpg")
+    create_test_image(size=(2000, 1000)).save(path)
+    proxy, scale = proxy_image(path, max_long_edge=500)
+    assert proxy.size == (500, 250)
+    assert scale == 0.25
+
+    distortions = [
+        {"type": "Blur", "intensity": 0.4},
+        {"type": "Rain", "intensity": 0.5, "seed": 1},
+        {"type": "Warp", "intensity": 0.5, "warp_params": {"wave_amplitude": 20.0, "wave_frequency": 0.04, "bulge_factor": 30.0}},
+        {"type": "Brightness", "intensity": 0.3},
+    ]
+    scaled = scale_distortions(distortions, scale)
+    assert scaled[0]["intensity"] == pytest.approx(0.1)
+    assert scaled[1]["scale"] == 0.25
+    assert scaled[2]["warp_params"] == pytest.approx({"wave_amplitude": 5.0, "wave_frequency": 0.16, "bulge_factor": 7.5})
+    assert scaled[3] == distortions[3]
+    assert "scale" not in distortions[1]  # The original settings are left alone
+    assert apply_distortions(proxy, scaled).size == proxy.size
+
+def test_apply_rain_effect_default_scale_unchanged():
+    image = create_test_image(size=(120, 80))
+    assert apply_rain_effect(image, 0.5, seed=3).tobytes() == apply_rain_effect(image, 0.5, seed=3, scale=1.0).tobytes()
+    assert apply_rain_effect(image, 0.5, seed=3, scale=0.5).size == image.size
+
+def test_run_bulk_analysis_pipeline_matches_threads(mocker, tmp_path):
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text='Fine ===JSON==={"road_conditions": "dry"}===JSON===')
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+
+    jobs = []
+    for i in range(5):
+        path = str(tmp_path / f"{i}.png")
+        create_test_image(size=(80, 60), color=(i * 40, 0, 0)).save(path)
+        jobs.append({"file": path, "file_name": f"{i}.png", "input_text": "Prompt",
+                     "distortions": [{"type": "Rain", "intensity": 0.3, "seed": i}]})
+    jobs[4]["file"] = open(jobs[4]["file"], "rb")  # Uploaded files are passed to the workers as bytes
+
+    def run(**options):
+        rows = {}
+        for unit, unit_rows, error in run_bulk_analysis(jobs, "test-model", None, ["road_conditions"], max_workers=2, **options):
+            assert error is None
+            rows.update({i: {k: v for k, v in row.items() if not k.endswith("Time (s)")} for i, row in zip(unit, unit_rows)})
+        return rows
+
+    threaded = run()
+    jobs[4]["file"].seek(0)
+    pipelined = run(cpu_workers=2)
+    jobs[4]["file"].close()
+    assert pipelined == threaded
+    assert sorted(pipelined) == list(range(5))
+    assert pipelined[0]["road_conditions"] == "dry" and pipelined[0]["Payload Bytes"] > 0
+
+def test_discover_images_filters_and_recurses(tmp_path):
+    for name in ["b.png", "a.jpg", "notes.txt", "a_mask.png", "cam1/c.jpeg", "cam1/raw/d.png", "cam2/e.png"]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(b"")
+
+    def names(**options):
+        return [os.path.relpath(p, tmp_path).replace(os.sep, "/") for p in discover_images(str(tmp_path), **options)]
+
+    assert names() == ["a.jpg", "a_mask.png", "b.png"]
+    assert names(recursive=True) == ["a.jpg", "a_mask.png", "b.png", "cam1/c.jpeg", "cam1/raw/d.png", "cam2/e.png"]
+    assert names(recursive=True, include=["cam1/*"], exclude=["*/raw/*"]) == ["cam1/c.jpeg"]
+    assert names(recursive=True, exclude=["*_mask.png", "cam2/*"]) == ["a.jpg", "b.png", "cam1/c.jpeg", "cam1/raw/d.png"]
+
+def test_discover_images_sampling_and_limit(tmp_path):
+    for i in range(20):
+        (tmp_path / f"frame_{i:03d}.png").write_bytes(b"")
+    all_frames = discover_images(str(tmp_path))
+
+    assert discover_images(str(tmp_path), every_nth=5) == all_frames[::5]
+    assert discover_images(str(tmp_path), limit=3) == all_frames[:3]
+    sample = discover_images(str(tmp_path), sample=6, seed=1)
+    assert len(sample) == 6 and sample == sorted(sample) and set(sample) <= set(all_frames)
+    assert sample == discover_images(str(tmp_path), sample=6, seed=1)
+    assert discover_images(str(tmp_path), sample=50) == all_frames
+
+def test_cached_overlay_matches_pil_compositing():
+    clear_overlay_cache()
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (60, 80, 3), dtype=np.uint8))
+    overlay = Image.fromarray(rng.integers(0, 256, (30, 40, 4), dtype=np.uint8), "RGBA")
+    buffer = io.BytesIO()
+    overlay.save(buffer, format="PNG")
+
+    for intensity in [0.0, 0.3, 0.5, 1.0]:
+        faded = Image.blend(Image.new("RGBA", image.size, (0, 0, 0, 0)), overlay.resize(image.size), intensity)
+        expected = np.array(Image.alpha_composite(image.convert("RGBA"), faded).convert("RGB"))
+        assert np.array_equal(np.array(apply_overlay(image, intensity, buffer.getvalue())), expected)
+        assert np.array_equal(np.array(apply_overlay(image, intensity, overlay)), expected)
+        compiled = compile_distortions([{"type": "Overlay", "intensity": intensity, "overlay_image": buffer.getvalue()}])
+        assert np.array_equal(np.array(compiled(image)), expected)
+
+    stats = get_overlay_cache_stats()
+    assert stats["entries"] == 8 and stats["hits"] == 4
+
+def test_sweep_distortions_shares_prefixes(mocker):
+    chains = expand_distortion_grid([{"type": "Blur", "intensity": [0.0, 0.5]},
+                                     {"type": "Rain", "intensity": [0.0, 0.3], "seed": 1}])
+    assert [setting for _, setting in chains] == [
+        {"Blur intensity": 0.0, "Rain intensity": 0.0}, {"Blur intensity": 0.0, "Rain intensity": 0.3},
+        {"Blur intensity": 0.5, "Rain intensity": 0.0}, {"Blur intensity": 0.5, "Rain intensity": 0.3}]
+    assert chains[3][0] == [{"type": "Blur", "intensity": 0.5}, {"type": "Rain", "intensity": 0.3, "seed": 1}]
+
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (40, 50, 3), dtype=np.uint8))
+    expected = [apply_distortions(image, chain) for chain, _ in chains]
+    spy = mocker.spy(utils_module, "apply_distortion")
+    swept = dict(sweep_distortions(image, [chain for chain, _ in chains]))
+    assert spy.call_count == 6  # Each Blur once, then each Rain per Blur
+    assert all(swept[i].tobytes() == expected[i].tobytes() for i in range(4))
+
+def test_batch_runner_sweep_skips_identical_images(mocker, tmp_path):
+    from src import batch
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text='Clear road. ===JSON==={"road_conditions": "dry"}===JSON===')
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+    mocker.patch('google.generativeai.configure')
+    create_test_image(size=(40, 30), color=(90, 90, 90)).save(tmp_path / "a.png")
+    output = tmp_path / "results.csv"
+
+    # Blurring a plain grey image changes nothing, so both Blur settings without rain share one request
+    exit_code = batch.main([str(tmp_path), "--prompt", "Check the road", "--api-key", "test", "--output", str(output),
+                            "--sweep", '[{"type": "Rain", "intensity": [0.0, 0.3], "seed": 1}, {"type": "Blur", "intensity": [0.0, 0.5]}]'])
+    assert exit_code == 0
+    assert mock_model.generate_content.call_count == 3
+    results = read_results(str(output), ["road_conditions"])
+    assert len(results) == 4
+    assert list(results["Rain intensity"]) == [0.0, 0.0, 0.3, 0.3]
+    assert list(results["Blur intensity"]) == [0.0, 0.5, 0.0, 0.5]
+    assert list(results["Identical To"]) == ["", results["Distortions"][0], "", ""]
+    assert list(results["road_conditions"]) == ["dry"] * 4
+
+def test_sweep_failures_only_fail_their_own_rows(mocker, tmp_path):
+    ok = mocker.Mock(text='Clear road. ===JSON==={"road_conditions": "dry"}===JSON===')
+    mock_model = mocker.Mock()
+    mock_model.generate_content.side_effect = [ok, ValueError("invalid argument"), ok]
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+    path = str(tmp_path / "a.png")
+    create_test_image(size=(40, 30), color=(90, 90, 90)).save(path)
+    jobs = [{"file": path, "file_name": "a.png", "input_text": "Prompt", "distortions": []},
+            {"file": str(tmp_path / "missing.png"), "file_name": "missing.png", "input_text": "Prompt", "distortions": []}]
+    chains = expand_distortion_grid([{"type": "Brightness", "intensity": [0.0, 0.2, 0.4]}])
+
+    outcomes = {}
+    for indices, rows, error in run_sweep_analysis(jobs, chains, "test-model", None, ["road_conditions"], max_workers=1):
+        for position, i in enumerate(indices):
+            outcomes[i] = error if error is not None else rows[position]["Status"]
+    assert [outcomes[i] for i in range(3)] == ["ok", "failed", "ok"]
+    # An unreadable image fails all of its rows
+    assert all(isinstance(outcomes[i], FileNotFoundError) for i in (3, 4, 5))
+
+def test_benchmark_comparison_flags_regressions():
+    from tests.benchmarks.run_benchmarks import compare_results, measure
+    result = measure(lambda: apply_distortions(create_test_image(), [{"type": "Blur", "intensity": 0.1}]), repeat=2)
+    assert set(result) == {"seconds", "min_seconds", "cold_seconds", "peak_bytes"}
+
+    baseline = {"results": {"Warp": {"seconds": 1.0, "peak_bytes": 100}, "Rain": {"seconds": 1.0, "peak_bytes": 100}}}
+    current = {"results": {"Warp": {"seconds": 1.2, "peak_bytes": 300}, "Rain": {"seconds": 2.0, "peak_bytes": 100},
+                           "Blur": {"seconds": 5.0, "peak_bytes": 100}}}
+    assert compare_results(current, baseline) == [("Warp", "peak_bytes", 100, 300), ("Rain", "seconds", 1.0, 2.0)]
+
+    # Peak resident memory is compared too when both runs measured it
+    baseline["results"]["Rain"]["peak_rss_bytes"] = 1000
+    current["results"]["Rain"]["peak_rss_bytes"] = 2000
+    assert ("Rain", "peak_rss_bytes", 1000, 2000) in compare_results(current, baseline)
+
+def test_bulk_rows_record_stage_timings_and_tokens(mocker, tmp_path):
+    usage = mocker.Mock(prompt_token_count=1290, candidates_token_count=85)
+    mock_model = mocker.Mock()
+    mock_model.generate_content.return_value = mocker.Mock(text='Fine ===JSON==={"road_conditions": "dry"}===JSON===',
+                                                           usage_metadata=usage)
+    mocker.patch('google.generativeai.GenerativeModel', return_value=mock_model)
+    path = str(tmp_path / "a.png")
+    create_test_image().save(path)
+    jobs = [{"file": path, "file_name": "a.png", "input_text": "Prompt", "distortions": [{"type": "Blur", "intensity": 0.2}]}]
+
+    [(_, rows, error)] = list(run_bulk_analysis(jobs, "test-model", None, ["road_conditions"]))
+    assert error is None
+    row = rows[0]
+    assert all(row[column] > 0 for column in STAGE_COLUMNS.values())
+    assert (row["Prompt Tokens"], row["Response Tokens"]) == (1290, 85)
+    assert row["Request Bytes"] == row["Payload Bytes"] + len("Prompt")
+    assert row["Response Bytes"] == len('Fine ===JSON==={"road_conditions": "dry"}===JSON===')
+
+    percentiles = stage_percentiles([row, {**row, "Request Time (s)": 3.0}])
+    assert list(percentiles.columns) == ["p50", "p95"]
+    assert percentiles.loc["Request", "p95"] > percentiles.loc["Request", "p50"]
+
+def test_prepare_bulk_image_decodes_undistorted_jpeg_at_upload_size(tmp_path):
+    path = str(tmp_path / "a.jpg")
+    create_test_image(size=(1600, 1200)).save(path)
+    job = {"file": path, "file_name": "a.jpg", "input_text": "Prompt", "distortions": []}
+    stats = {}
+    assert prepare_bulk_image(job, stats=stats, max_long_edge=200).size == (200, 150)
+    assert stats["decode_seconds"] > 0
+    # Distortions still work on the full image
+    job["distortions"] = [{"type": "Blur", "intensity": 0.2}]
+    assert prepare_bulk_image(job, max_long_edge=200).size == (1600, 1200)
+
+def test_seeded_rain_layers_are_cached_and_rotated():
+    clear_rain_cache()
+    frames = [create_test_image(size=(120, 80), color=(i * 30, 40, 60)) for i in range(4)]
+    distortions = [{"type": "Rain", "intensity": 0.5, "seed": 2, "variants": 2}]
+    rained = [apply_distortions(frame, assign_rain_variants(distortions, i)) for i, frame in enumerate(frames)]
+    assert [assign_rain_variants(distortions, i)[0]["variant"] for i in range(4)] == [0, 1, 0, 1]
+
+    stats = get_rain_cache_stats()
+    assert (stats["misses"], stats["hits"], stats["entries"]) == (2, 2, 2)
+    # Frames 0 and 2 share a layer, frames 0 and 1 do not
+    streaks = [np.array(r).astype(int) - np.array(f).astype(int) > 0 for r, f in zip(rained, frames)]
+    assert np.array_equal(streaks[0], streaks[2]) and not np.array_equal(streaks[0], streaks[1])
+    # Variant 0 is the plain seeded layer, and a cached layer gives the same image as a fresh one
+    assert rained[0].tobytes() == apply_rain_effect(frames[0], 0.5, seed=2).tobytes()
+    clear_rain_cache()
+    assert rained[1].tobytes() == apply_rain_effect(frames[1], 0.5, seed=2, variant=1).tobytes()